@@ -32,6 +32,78 @@ class Settings:
     # OpenAI (per ricerca semantica)
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     
+    OPENAI_TIMEOUT_SECONDS: float = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "5"))
+    OPENAI_CONNECT_TIMEOUT_SECONDS: float = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "2"))
+    OPENAI_BREAKER_FAILURES: int = int(os.getenv("OPENAI_BREAKER_FAILURES", "3"))  # Errori prima di aprire
+    OPENAI_BREAKER_COOLDOWN_SECONDS: float = float(os.getenv("OPENAI_BREAKER_COOLDOWN_SECONDS", "60"))
+    
+    # Provider embeddings: openai | local (offline, CPU) | fake (test)
+    EMBEDDING_PROVIDER: str = os.getenv("EMBEDDING_PROVIDER", "openai")
+    LOCAL_EMBEDDING_DIM: int = int(os.getenv("LOCAL_EMBEDDING_DIM", "512"))
+    
+    # Embeddings: formato di storage (BLOB binario), float32 o float16
+    EMBEDDING_DTYPE: str = os.getenv("EMBEDDING_DTYPE", "float32")
+    
+    # Profilo embeddings: componenti mantenute (0 = tutte, es. 256/512 con
+    # text-embedding-3; per il provider local usare LOCAL_EMBEDDING_DIM)
+    # e quantizzazione scalare per vettore: none | int8
+    EMBEDDING_DIMENSIONS: int = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
+    EMBEDDING_QUANTIZATION: str = os.getenv("EMBEDDING_QUANTIZATION", "none")
+    
+    # Cache embeddings: LRU in memoria + tabella SQLite persistente
+    EMBEDDING_CACHE_MAX_ENTRIES: int = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2048"))
+    EMBEDDING_CACHE_MAX_BYTES: int = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    
+    # Tokenizer FTS5: unicode61 (accenti rimossi, indici prefix 2/3/4)
+    # oppure trigram (sottostringhe, tollerante a parole composte)
+    FTS_TOKENIZER: str = os.getenv("FTS_TOKENIZER", "unicode61")
+    FTS_PREFIX_INDEXES: str = os.getenv("FTS_PREFIX_INDEXES", "2 3 4")
+    
+    # Ricerca fuzzy: termini sconosciuti corretti col termine indicizzato
+    # più vicino (distanza di edit massima; termini più corti ignorati)
+    FUZZY_SEARCH_ENABLED: bool = os.getenv("FUZZY_SEARCH_ENABLED", "true").lower() in ("1", "true", "yes")
+    FUZZY_MAX_DISTANCE: int = int(os.getenv("FUZZY_MAX_DISTANCE", "2"))
+    FUZZY_MIN_TERM_LENGTH: int = int(os.getenv("FUZZY_MIN_TERM_LENGTH", "4"))
+    
+    # Pesi bm25 delle colonne FTS5 (descrizione, nome location, percorso)
+    FTS_WEIGHT_DESCRIPTION: float = float(os.getenv("FTS_WEIGHT_DESCRIPTION", "10.0"))
+    FTS_WEIGHT_LOCATION_NAME: float = float(os.getenv("FTS_WEIGHT_LOCATION_NAME", "4.0"))
+    FTS_WEIGHT_LOCATION_PATH: float = float(os.getenv("FTS_WEIGHT_LOCATION_PATH", "2.0"))
+    
+    # Ricerca ibrida (Reciprocal Rank Fusion di FTS5 + semantica)
+    HYBRID_RRF_K: int = int(os.getenv("HYBRID_RRF_K", "60"))
+    HYBRID_FTS_WEIGHT: float = float(os.getenv("HYBRID_FTS_WEIGHT", "1.0"))
+    HYBRID_SEMANTIC_WEIGHT: float = float(os.getenv("HYBRID_SEMANTIC_WEIGHT", "1.0"))
+    
+    # Budget di latenza della semantica in auto/hybrid: oltre, risultati
+    # solo FTS5 marcati partial (0 = attende sempre l'embedding della query)
+    SEARCH_SEMANTIC_BUDGET_MS: int = int(os.getenv("SEARCH_SEMANTIC_BUDGET_MS", "300"))
+    SEARCH_EMBEDDING_WORKERS: int = int(os.getenv("SEARCH_EMBEDDING_WORKERS", "4"))
+    
+    # Ricerca batch: query massime per richiesta
+    SEARCH_BATCH_MAX_QUERIES: int = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "100"))
+    
+    # Cache risultati di ricerca (invalidata ad ogni scrittura)
+    SEARCH_CACHE_MAX_ENTRIES: int = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+    SEARCH_CACHE_TTL_SECONDS: float = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+    
+    # Rigenerazione embeddings: testi per chiamata API / commit
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+    
+    # Worker embeddings in background
+    EMBEDDING_WORKER_POLL_SECONDS: float = float(os.getenv("EMBEDDING_WORKER_POLL_SECONDS", "30"))
+    EMBEDDING_RETRY_BASE_SECONDS: float = 2.0   # Backoff esponenziale dopo errori
+    EMBEDDING_RETRY_MAX_SECONDS: float = 300.0
+    # Tentativi per item prima di FAILED (ritentati al riavvio dal reconciler)
+    EMBEDDING_MAX_ATTEMPTS: int = int(os.getenv("EMBEDDING_MAX_ATTEMPTS", "5"))
+    
+    # Indice ANN (IVF) per inventari grandi
+    ANN_ENABLED: bool = os.getenv("ANN_ENABLED", "false").lower() in ("1", "true", "yes")
+    ANN_MIN_ITEMS: int = int(os.getenv("ANN_MIN_ITEMS", "50000"))  # sotto: brute force
+    ANN_NLIST: int = int(os.getenv("ANN_NLIST", "0"))    # 0 = auto (4 * sqrt(n))
+    ANN_NPROBE: int = int(os.getenv("ANN_NPROBE", "8"))  # cluster visitati per query
+    ANN_INDEX_PATH: Path = DATA_DIR / "ann_ivf.npz"
+    
     # App Info
     APP_NAME: str = "Magazzino Caos Ordinato"
     APP_VERSION: str = "1.0.0"
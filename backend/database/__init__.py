@@ -1,3 +1,3 @@
 # Database Package
-from .connection import get_db, engine, SessionLocal
-from .models import Base, Location, Item, ItemStatus
+from .connection import get_db, engine, SessionLocal, BackgroundSessionLocal
+from .models import Base, Location, Item, ItemStatus, EmbeddingStatus, AppMeta
@@ -32,8 +32,20 @@ def _set_sqlite_pragma(dbapi_conn, connection_record):
     cursor.close()
 
 
+# Engine per il lavoro in background (worker embeddings, cache su disco):
+# connessioni proprie da un pool, una per thread alla volta. Sulla
+# connessione condivisa di `engine` il commit/close di una sessione in
+# un altro thread chiuderebbe la transazione della richiesta in corso.
+background_engine = create_engine(
+    settings.DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    echo=False
+)
+
+
 # Registra il listener per ogni nuova connessione
 event.listen(engine, "connect", _set_sqlite_pragma)
+event.listen(background_engine, "connect", _set_sqlite_pragma)
 
 
 # Session factory
@@ -44,6 +56,14 @@ SessionLocal = sessionmaker(
 )
 
 
+# Session factory per i thread in background (mai nel request path)
+BackgroundSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=background_engine
+)
+
+
 def get_db():
     """
     Dependency per FastAPI: fornisce una sessione DB per request.
@@ -3,6 +3,7 @@ Inizializzazione database e setup FTS5 per ricerca full-text.
 """
 from sqlalchemy import text
 
+from ..config import settings
 from .connection import engine
 from .models import Base
 
@@ -18,6 +19,9 @@ def init_database():
     # Esegui migrazioni per colonne mancanti
     _run_migrations()
     
+    # Converte embeddings nel formato/profilo configurato
+    _migrate_embedding_storage()
+    
     # Setup FTS5 per ricerca veloce
     _setup_fts5()
 
@@ -40,6 +44,18 @@ def _run_migrations():
             ))
             conn.commit()
         
+        # Migrazione: percorso materializzato delle locations
+        if 'path' not in columns:
+            conn.execute(text(
+                "ALTER TABLE locations ADD COLUMN path VARCHAR(512)"
+            ))
+            conn.commit()
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_locations_path ON locations (path)"
+        ))
+        _backfill_location_paths(conn)
+        conn.commit()
+        
         # Migrazione: aggiungi embedding a items se non esiste
         result = conn.execute(text(
             "PRAGMA table_info(items)"
@@ -48,60 +64,388 @@ def _run_migrations():
         
         if 'embedding' not in item_columns:
             conn.execute(text(
-                "ALTER TABLE items ADD COLUMN embedding TEXT"
+                "ALTER TABLE items ADD COLUMN embedding BLOB"
+            ))
+            conn.commit()
+        
+        # Migrazione: aggiungi embedding_hash a items se non esiste
+        if 'embedding_hash' not in item_columns:
+            conn.execute(text(
+                "ALTER TABLE items ADD COLUMN embedding_hash VARCHAR(64)"
             ))
             conn.commit()
+        
+        # Migrazione: aggiungi embedding_model a items se non esiste
+        # (valorizzato dal reconciler del worker embeddings)
+        if 'embedding_model' not in item_columns:
+            conn.execute(text(
+                "ALTER TABLE items ADD COLUMN embedding_model VARCHAR(100)"
+            ))
+            conn.commit()
+        
+        # Migrazione: tentativi falliti del worker embeddings
+        if 'embedding_attempts' not in item_columns:
+            conn.execute(text(
+                "ALTER TABLE items ADD COLUMN embedding_attempts INTEGER NOT NULL DEFAULT 0"
+            ))
+            conn.commit()
+        
+        # Migrazione: aggiungi embedding_status a items se non esiste.
+        # Items già con embedding -> READY, con descrizione -> PENDING
+        # (li completa il worker in background)
+        if 'embedding_status' not in item_columns:
+            conn.execute(text(
+                "ALTER TABLE items ADD COLUMN embedding_status VARCHAR(7)"
+            ))
+            conn.execute(text(
+                "UPDATE items SET embedding_status = CASE "
+                "WHEN embedding IS NOT NULL THEN 'READY' "
+                "WHEN trim(coalesce(description, '')) != '' THEN 'PENDING' "
+                "END"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS idx_items_embedding_status "
+                "ON items (embedding_status)"
+            ))
+            conn.commit()
+        
+        # Migrazione: covering index per i conteggi items per location
+        # (create_all non aggiunge indici a tabelle già esistenti)
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_items_location_counts "
+            "ON items (location_id, status, previous_location_id, deleted_at)"
+        ))
+        conn.commit()
+
+
+def _backfill_location_paths(conn):
+    """
+    Calcola `path` delle locations che non lo hanno (database esistenti
+    o righe scritte da versioni precedenti) percorrendo parent_id dalle
+    radici. Le righe in un ciclo diventano radici.
+    """
+    missing = conn.execute(text(
+        "SELECT 1 FROM locations WHERE path IS NULL LIMIT 1"
+    )).fetchone()
+    if missing is None:
+        return
+    
+    conn.execute(text("""
+        WITH RECURSIVE tree(id, path) AS (
+            SELECT id, '/' || id || '/'
+            FROM locations
+            WHERE parent_id IS NULL
+               OR parent_id NOT IN (SELECT id FROM locations)
+            UNION ALL
+            SELECT locations.id, tree.path || locations.id || '/'
+            FROM locations JOIN tree ON locations.parent_id = tree.id
+            WHERE instr(tree.path, '/' || locations.id || '/') = 0
+        )
+        UPDATE locations
+        SET path = coalesce(
+            (SELECT tree.path FROM tree WHERE tree.id = locations.id),
+            '/' || id || '/'
+        )
+        WHERE path IS NULL
+    """))
+
+
+def _get_meta(conn, key: str):
+    """Legge un valore dalla tabella app_meta (None se assente)."""
+    row = conn.execute(
+        text("SELECT value FROM app_meta WHERE key = :key"),
+        {"key": key}
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn, key: str, value: str):
+    """Scrive un valore nella tabella app_meta."""
+    conn.execute(
+        text("INSERT OR REPLACE INTO app_meta (key, value) VALUES (:key, :value)"),
+        {"key": key, "value": value}
+    )
+
+
+def _migrate_embedding_storage(batch_size: int = 500):
+    """
+    Converte gli embeddings nel formato di storage configurato.
+    - Righe legacy in JSON (typeof = 'text') vengono parsate e impacchettate
+    - Se il profilo (EMBEDDING_DTYPE, EMBEDDING_QUANTIZATION,
+      EMBEDDING_DIMENSIONS) è cambiato, i BLOB esistenti vengono
+      ricodificati localmente, senza chiamate API
+    - Se il nuovo profilo chiede più dimensioni di quelle salvate, gli
+      embeddings non sono recuperabili: tornano PENDING per il worker
+    Safe to run multiple times.
+    """
+    from ..services.embeddings import (
+        apply_profile, blob_to_embedding, embedding_to_blob, json_to_embedding
+    )
+    
+    target_dtype = settings.EMBEDDING_DTYPE
+    target_quantization = settings.EMBEDDING_QUANTIZATION
+    target_dimensions = settings.EMBEDDING_DIMENSIONS
+    
+    with engine.connect() as conn:
+        stored_dtype = _get_meta(conn, "embedding_dtype")
+        stored_quantization = _get_meta(conn, "embedding_quantization") or "none"
+        stored_dimensions = int(_get_meta(conn, "embedding_dimensions") or 0)
+        
+        # Legacy JSON -> BLOB
+        rows = conn.execute(text(
+            "SELECT id, embedding FROM items "
+            "WHERE typeof(embedding) = 'text'"
+        )).fetchall()
+        updates = []
+        for item_id, embedding_json in rows:
+            embedding = json_to_embedding(embedding_json)
+            updates.append({
+                "id": item_id,
+                "embedding": (
+                    embedding_to_blob(apply_profile(embedding))
+                    if embedding else None
+                )
+            })
+        
+        profile_changed = stored_dtype is not None and (
+            stored_dtype != target_dtype
+            or stored_quantization != target_quantization
+            or stored_dimensions != target_dimensions
+        )
+        lost_dimensions = bool(stored_dimensions) and (
+            not target_dimensions or target_dimensions > stored_dimensions
+        )
+        
+        if profile_changed and lost_dimensions:
+            # Componenti troncate non recuperabili: rigenerazione
+            conn.execute(text(
+                "UPDATE items SET embedding = NULL, embedding_hash = NULL, "
+                "embedding_status = CASE "
+                "WHEN trim(coalesce(description, '')) != '' THEN 'PENDING' "
+                "END "
+                "WHERE typeof(embedding) = 'blob'"
+            ))
+        elif profile_changed:
+            # BLOB nel vecchio profilo -> BLOB nel profilo configurato
+            rows = conn.execute(text(
+                "SELECT id, embedding FROM items "
+                "WHERE typeof(embedding) = 'blob'"
+            )).fetchall()
+            for item_id, blob in rows:
+                embedding = blob_to_embedding(
+                    blob, dtype=stored_dtype, quantization=stored_quantization
+                )
+                updates.append({
+                    "id": item_id,
+                    "embedding": (
+                        embedding_to_blob(apply_profile(embedding))
+                        if embedding is not None else None
+                    )
+                })
+        
+        for start in range(0, len(updates), batch_size):
+            conn.execute(
+                text("UPDATE items SET embedding = :embedding WHERE id = :id"),
+                updates[start:start + batch_size]
+            )
+        
+        _set_meta(conn, "embedding_dtype", target_dtype)
+        _set_meta(conn, "embedding_quantization", target_quantization)
+        _set_meta(conn, "embedding_dimensions", str(target_dimensions))
+        conn.commit()
+
+
+# Versione dello schema FTS: cambiarla forza la ricostruzione dell'indice
+FTS_SCHEMA_VERSION = "3"
+
+# Riga FTS di un item: descrizione + nome e percorso della sua location.
+# Il percorso ("Garage / Scaffale") si ricava da locations.path ("/1/5/12/"):
+# gli id degli antenati, in ordine, diventano un array JSON e ogni nome
+# è una ricerca per chiave primaria, senza percorrere tutto l'albero.
+_FTS_ROW_SELECT = """
+    SELECT
+        items.id,
+        items.description,
+        locations.name,
+        coalesce((
+            SELECT group_concat(name, ' / ') FROM (
+                SELECT ancestor.name
+                FROM json_each('[' || replace(trim(locations.path, '/'), '/', ',') || ']') AS chain
+                JOIN locations AS ancestor ON ancestor.id = chain.value
+                WHERE chain.value != locations.id
+                ORDER BY chain.key
+            )
+        ), '')
+    FROM items
+    LEFT JOIN locations ON locations.id = items.location_id
+"""
+
+# Locations del sottoalbero di new (range sul percorso materializzato,
+# servito da idx_locations_path): '0' è il carattere successivo a '/'
+_SUBTREE_LOCATION_IDS = """
+    SELECT id FROM locations
+    WHERE path >= new.path
+      AND path < substr(new.path, 1, length(new.path) - 1) || '0'
+"""
 
 
 def _setup_fts5():
     """
     Configura la tabella virtuale FTS5 per ricerca full-text.
-    Usa contentless FTS5 sincronizzato con la tabella items.
+    Colonne: descrizione dell'item, nome della sua location e percorso
+    degli antenati, così "garage" o "scatola 12" trovano gli items
+    contenuti. Sincronizzata da trigger su items e locations
+    (rinomina e spostamento di una location aggiornano tutto il sottoalbero).
+    Se lo schema è cambiato l'indice viene ricreato e ripopolato.
+    I trigger toccano solo le righe interessate (item o sottoalbero),
+    mai l'intero albero delle locations.
     """
     with engine.connect() as conn:
-        # Verifica se la tabella FTS esiste già
-        result = conn.execute(text(
-            "SELECT name FROM sqlite_master "
-            "WHERE type='table' AND name='items_fts'"
+        signature = _fts5_signature()
+        if _get_meta(conn, "fts_schema") != signature:
+            _create_fts5(conn)
+            _populate_fts5(conn)
+            _set_meta(conn, "fts_schema", signature)
+        
+        # Vocabolario per la ricerca fuzzy (services/fuzzy_search.py):
+        # copia dei termini di fts5vocab + indice dei trigrammi
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts_vocab "
+            "USING fts5vocab(items_fts, 'row')"
+        ))
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS fts_vocab ("
+            "term TEXT PRIMARY KEY, doc INTEGER NOT NULL)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS fts_vocab_trigrams ("
+            "trigram TEXT NOT NULL, term TEXT NOT NULL, "
+            "PRIMARY KEY (trigram, term)) WITHOUT ROWID"
         ))
         
-        if result.fetchone() is None:
-            # Crea tabella FTS5
-            conn.execute(text("""
-                CREATE VIRTUAL TABLE items_fts USING fts5(
-                    description,
-                    content='items',
-                    content_rowid='id'
-                )
-            """))
-            
-            # Trigger per INSERT
-            conn.execute(text("""
-                CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
-                    INSERT INTO items_fts(rowid, description) 
-                    VALUES (new.id, new.description);
-                END
-            """))
-            
-            # Trigger per DELETE
-            conn.execute(text("""
-                CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
-                    INSERT INTO items_fts(items_fts, rowid, description) 
-                    VALUES ('delete', old.id, old.description);
-                END
-            """))
-            
-            # Trigger per UPDATE
-            conn.execute(text("""
-                CREATE TRIGGER items_fts_update AFTER UPDATE ON items BEGIN
-                    INSERT INTO items_fts(items_fts, rowid, description) 
-                    VALUES ('delete', old.id, old.description);
-                    INSERT INTO items_fts(rowid, description) 
-                    VALUES (new.id, new.description);
-                END
-            """))
-            
-            conn.commit()
+        # Pesi bm25 per colonna (applicati da ORDER BY rank)
+        conn.execute(
+            text("INSERT INTO items_fts(items_fts, rank) VALUES ('rank', :rank)"),
+            {"rank": "bm25({}, {}, {})".format(
+                float(settings.FTS_WEIGHT_DESCRIPTION),
+                float(settings.FTS_WEIGHT_LOCATION_NAME),
+                float(settings.FTS_WEIGHT_LOCATION_PATH)
+            )}
+        )
+        conn.commit()
+
+
+def _fts5_options() -> str:
+    """
+    Opzioni della tabella FTS5 da settings.FTS_TOKENIZER:
+    - unicode61: "perché"/"perche" e "cassettò"/"cassetto" coincidono
+      (remove_diacritics 2) e le prefix query usano indici dedicati
+    - trigram: match per sottostringa (minimo 3 caratteri)
+    """
+    if settings.FTS_TOKENIZER == "unicode61":
+        options = "tokenize = 'unicode61 remove_diacritics 2'"
+        if settings.FTS_PREFIX_INDEXES.strip():
+            options += f", prefix = '{settings.FTS_PREFIX_INDEXES.strip()}'"
+        return options
+    if settings.FTS_TOKENIZER == "trigram":
+        return "tokenize = 'trigram'"
+    raise ValueError(f"Tokenizer FTS5 sconosciuto: {settings.FTS_TOKENIZER}")
+
+
+def _fts5_signature() -> str:
+    """Versione schema + opzioni: se cambia, l'indice va ricostruito."""
+    return f"{FTS_SCHEMA_VERSION}; {_fts5_options()}"
+
+
+def _create_fts5(conn):
+    """(Ri)crea tabella FTS5 e trigger di sincronizzazione."""
+    for trigger in (
+        "items_fts_insert", "items_fts_delete", "items_fts_update",
+        "locations_fts_update", "locations_fts_rename", "locations_fts_move"
+    ):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    conn.execute(text("DROP TABLE IF EXISTS items_fts_vocab"))
+    conn.execute(text("DROP TABLE IF EXISTS fts_vocab"))
+    conn.execute(text("DROP TABLE IF EXISTS fts_vocab_trigrams"))
+    conn.execute(text("DROP TABLE IF EXISTS items_fts"))
+    conn.execute(text("DROP VIEW IF EXISTS location_paths"))  # Schema FTS 2
+    
+    conn.execute(text(f"""
+        CREATE VIRTUAL TABLE items_fts USING fts5(
+            description,
+            location_name,
+            location_path,
+            {_fts5_options()}
+        )
+    """))
+    
+    # Trigger per INSERT
+    conn.execute(text(f"""
+        CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts(rowid, description, location_name, location_path)
+            {_FTS_ROW_SELECT} WHERE items.id = new.id;
+        END
+    """))
+    
+    # Trigger per DELETE
+    conn.execute(text("""
+        CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+        END
+    """))
+    
+    # Trigger per UPDATE: solo se cambiano descrizione o location, così
+    # le scritture massive di embeddings non riscrivono l'indice FTS
+    conn.execute(text(f"""
+        CREATE TRIGGER items_fts_update AFTER UPDATE OF description, location_id ON items
+        WHEN old.description IS NOT new.description
+          OR old.location_id IS NOT new.location_id
+        BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+            INSERT INTO items_fts(rowid, description, location_name, location_path)
+            {_FTS_ROW_SELECT} WHERE items.id = new.id;
+        END
+    """))
+    
+    # Rinomina: cambia nome o percorso degli items della location e
+    # di tutte le discendenti (range su locations.path)
+    conn.execute(text(f"""
+        CREATE TRIGGER locations_fts_rename AFTER UPDATE OF name ON locations
+        WHEN old.name IS NOT new.name
+        BEGIN
+            DELETE FROM items_fts WHERE rowid IN (
+                SELECT id FROM items
+                WHERE location_id IN ({_SUBTREE_LOCATION_IDS})
+            );
+            INSERT INTO items_fts(rowid, description, location_name, location_path)
+            {_FTS_ROW_SELECT}
+            WHERE items.location_id IN ({_SUBTREE_LOCATION_IDS});
+        END
+    """))
+    
+    # Spostamento: move_subtree riscrive `path` di ogni location del
+    # sottoalbero, quindi ogni riga riallinea solo i propri items
+    conn.execute(text(f"""
+        CREATE TRIGGER locations_fts_move AFTER UPDATE OF path ON locations
+        WHEN old.path IS NOT new.path
+        BEGIN
+            DELETE FROM items_fts WHERE rowid IN (
+                SELECT id FROM items WHERE location_id = new.id
+            );
+            INSERT INTO items_fts(rowid, description, location_name, location_path)
+            {_FTS_ROW_SELECT}
+            WHERE items.location_id = new.id;
+        END
+    """))
+
+
+def _populate_fts5(conn):
+    """Riempie items_fts da zero a partire da items e locations."""
+    conn.execute(text("DELETE FROM items_fts"))
+    conn.execute(text(f"""
+        INSERT INTO items_fts(rowid, description, location_name, location_path)
+        {_FTS_ROW_SELECT}
+    """))
 
 
 def rebuild_fts_index():
@@ -110,5 +454,5 @@ def rebuild_fts_index():
     Utile dopo import massivi o corruzione.
     """
     with engine.connect() as conn:
-        conn.execute(text("INSERT INTO items_fts(items_fts) VALUES('rebuild')"))
+        _populate_fts5(conn)
         conn.commit()
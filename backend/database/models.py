@@ -7,7 +7,7 @@ from typing import Optional, List
 
 from sqlalchemy import (
     Column, Integer, String, Text, DateTime, 
-    ForeignKey, Enum, JSON, Index
+    ForeignKey, Enum, JSON, Index, LargeBinary
 )
 from sqlalchemy.orm import declarative_base, relationship
 
@@ -23,6 +23,13 @@ class ItemStatus(enum.Enum):
     LOANED = "loaned"        # Prestato a qualcuno
 
 
+class EmbeddingStatus(enum.Enum):
+    """Stato dell'embedding di un item."""
+    PENDING = "pending"  # Da generare (worker in background)
+    READY = "ready"      # Generato e indicizzato
+    FAILED = "failed"    # Tentativi esauriti (ritentato al riavvio)
+
+
 class Location(Base):
     """
     Rappresenta una location (posizione, scaffale, stanza).
@@ -34,6 +41,7 @@ class Location(Base):
     name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
     parent_id = Column(Integer, ForeignKey("locations.id"), nullable=True)
+    path = Column(String(512), nullable=True)  # Percorso materializzato "/1/5/12/" (antenati + sé)
     context_photos = Column(JSON, nullable=True)  # Array di path foto contesto
     created_at = Column(DateTime, default=datetime.utcnow)
     deleted_at = Column(DateTime, nullable=True)  # Soft delete
@@ -59,11 +67,6 @@ class Location(Base):
     @property
     def is_deleted(self) -> bool:
         return self.deleted_at is not None
-    
-    @property
-    def item_count(self) -> int:
-        """Conta gli item attivi (non eliminati) in questa location."""
-        return len([i for i in self.items if i.deleted_at is None])
 
 
 class Item(Base):
@@ -87,7 +90,11 @@ class Item(Base):
     photo_path = Column(String(255), nullable=False)
     thumbnail_path = Column(String(255), nullable=False)
     description = Column(Text, nullable=True)
-    embedding = Column(Text, nullable=True)  # JSON array per ricerca semantica
+    embedding = Column(LargeBinary, nullable=True)  # Vettore packed (EMBEDDING_DTYPE o int8 + scala)
+    embedding_hash = Column(String(64), nullable=True)  # Hash modello + descrizione
+    embedding_model = Column(String(100), nullable=True)  # Modello che ha generato l'embedding
+    embedding_status = Column(Enum(EmbeddingStatus), nullable=True)  # None = senza descrizione
+    embedding_attempts = Column(Integer, default=0, server_default="0", nullable=False)  # Tentativi falliti del worker
     status = Column(
         Enum(ItemStatus), 
         default=ItemStatus.AVAILABLE,
@@ -105,7 +112,38 @@ class Item(Base):
         return self.deleted_at is not None
 
 
+class AppMeta(Base):
+    """
+    Coppie chiave/valore per lo stato interno dell'applicazione.
+    Usato dalle migrazioni (es. formato di storage degli embeddings).
+    """
+    __tablename__ = "app_meta"
+    
+    key = Column(String(50), primary_key=True)
+    value = Column(Text, nullable=True)
+
+
+class EmbeddingCacheEntry(Base):
+    """
+    Cache persistente degli embeddings generati.
+    Chiave: SHA-256 di modello + testo normalizzato.
+    """
+    __tablename__ = "embedding_cache"
+    
+    key = Column(String(64), primary_key=True)
+    model = Column(String(100), nullable=False)
+    embedding = Column(LargeBinary, nullable=False)  # float32 packed
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 # Indice per ricerche comuni
 Index("idx_items_location", Item.location_id)
 Index("idx_items_status", Item.status)
+Index("idx_items_embedding_status", Item.embedding_status)
 Index("idx_locations_parent", Location.parent_id)
+Index("idx_locations_path", Location.path)
+# Covering index per i conteggi per location (GROUP BY senza leggere le righe)
+Index(
+    "idx_items_location_counts",
+    Item.location_id, Item.status, Item.previous_location_id, Item.deleted_at
+)
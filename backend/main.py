@@ -10,6 +10,11 @@ from fastapi.staticfiles import StaticFiles
 
 from .config import settings
 from .database.migrations import init_database
+from .services import embeddings
+from .services.embedding_worker import embedding_worker, reconcile_embeddings
+from .services.fuzzy_search import fuzzy_vocabulary
+from .services.search_cache import search_cache
+from .services.suggest_index import load_suggest_index
 from .routers import (
     locations_router,
     items_router,
@@ -21,12 +26,19 @@ from .routers import (
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    Lifecycle manager: inizializza database all'avvio.
+    Lifecycle manager: inizializza database, indice semantico e
+    indice di autocompletamento all'avvio.
     """
     # Startup
     init_database()
+    reconcile_embeddings()  # Prima dell'indice: niente vettori obsoleti in memoria
+    embeddings.load_index()
+    load_suggest_index()
+    await embedding_worker.start()
     yield
-    # Shutdown (cleanup se necessario)
+    # Shutdown: ferma il worker e persiste l'indice ANN (se attivo)
+    await embedding_worker.stop()
+    embeddings.save_ann_index()
 
 
 # Crea applicazione FastAPI
@@ -84,7 +96,12 @@ def health_check():
     return {
         "status": "ok",
         "app": settings.APP_NAME,
-        "version": settings.APP_VERSION
+        "version": settings.APP_VERSION,
+        "embeddings": embeddings.get_provider().status(),
+        "embedding_index": embeddings.embedding_index.stats(),
+        "embedding_cache": embeddings.embedding_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "fuzzy_search": fuzzy_vocabulary.stats()
     }
 
 
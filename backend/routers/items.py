@@ -8,7 +8,9 @@ from fastapi import APIRouter, Depends, HTTPException, Query, status
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 
-from ..database import get_db, Item, Location, ItemStatus
+from ..database import get_db, Item, Location, ItemStatus, EmbeddingStatus
+from ..services.search_cache import bump_data_generation
+from ..services.suggest_index import suggest_index
 
 
 router = APIRouter(prefix="/items", tags=["items"])
@@ -222,9 +224,10 @@ def create_item(
     """
     Crea un nuovo item.
     Chiamato dopo upload immagine.
-    Genera automaticamente embedding per ricerca semantica.
+    L'embedding per la ricerca semantica viene generato in background
+    (embedding_status = PENDING): nessuna chiamata API nel request path.
     """
-    from ..services import embeddings
+    from ..services.embedding_worker import embedding_worker
     
     # Verifica location
     location = db.query(Location).filter(
@@ -238,25 +241,26 @@ def create_item(
             detail="Location non valida"
         )
     
-    # Genera embedding se descrizione presente
-    embedding_json = None
-    if data.description and embeddings.is_semantic_search_available():
-        embedding = embeddings.generate_embedding(data.description)
-        if embedding:
-            embedding_json = embeddings.embedding_to_json(embedding)
+    # Embedding da generare se descrizione presente
+    has_description = bool(data.description and data.description.strip())
     
     item = Item(
         location_id=data.location_id,
         photo_path=data.photo_path,
         thumbnail_path=data.thumbnail_path,
         description=data.description,
-        embedding=embedding_json,
+        embedding_status=EmbeddingStatus.PENDING if has_description else None,
         status=ItemStatus.AVAILABLE
     )
     
     db.add(item)
     db.commit()
+    bump_data_generation()
     db.refresh(item)
+    suggest_index.add(item.description)
+    
+    if has_description:
+        embedding_worker.notify()
     
     return ItemResponse(
         id=item.id,
@@ -279,7 +283,12 @@ def update_item(
     """
     Aggiorna un item.
     Usato per spostamenti (Flash Move) e cambio status.
+    Se cambia la descrizione l'embedding torna PENDING e viene
+    rigenerato in background dal worker.
     """
+    from ..services import embeddings
+    from ..services.embedding_worker import embedding_worker
+    
     item = db.query(Item).filter(
         Item.id == item_id,
         Item.deleted_at.is_(None)
@@ -291,6 +300,8 @@ def update_item(
             detail="Item non trovato"
         )
     
+    old_description = item.description
+    
     if data.location_id is not None:
         # Verifica nuova location
         location = db.query(Location).filter(
@@ -306,8 +317,19 @@ def update_item(
         # Se spostiamo in una location, status torna AVAILABLE
         item.status = ItemStatus.AVAILABLE
     
-    if data.description is not None:
+    description_changed = (
+        data.description is not None and data.description != item.description
+    )
+    if description_changed:
         item.description = data.description
+        item.embedding = None
+        item.embedding_hash = None
+        item.embedding_model = None
+        item.embedding_attempts = 0
+        item.embedding_status = (
+            EmbeddingStatus.PENDING
+            if data.description.strip() else None
+        )
     
     if data.status is not None:
         item.status = data.status
@@ -316,7 +338,15 @@ def update_item(
             item.location_id = None
     
     db.commit()
+    bump_data_generation()
     db.refresh(item)
+    suggest_index.replace(old_description, item.description)
+    
+    if description_changed:
+        # Fino alla rigenerazione l'item resta trovabile via FTS5
+        embeddings.unindex_item(item.id)
+        if item.embedding_status == EmbeddingStatus.PENDING:
+            embedding_worker.notify()
     
     return ItemResponse(
         id=item.id,
@@ -358,6 +388,7 @@ def pick_item(
     item.location_id = None
     
     db.commit()
+    bump_data_generation()
     db.refresh(item)
     
     # Recupera nome previous location
@@ -411,6 +442,7 @@ def bulk_move_items(
         item.status = ItemStatus.AVAILABLE
     
     db.commit()
+    bump_data_generation()
     
     return [
         ItemResponse(
@@ -433,6 +465,8 @@ def delete_item(
     db: Session = Depends(get_db)
 ):
     """Soft delete di un item."""
+    from ..services import embeddings
+    
     item = db.query(Item).filter(
         Item.id == item_id,
         Item.deleted_at.is_(None)
@@ -446,3 +480,7 @@ def delete_item(
     
     item.deleted_at = datetime.utcnow()
     db.commit()
+    bump_data_generation()
+    suggest_index.remove(item.description)
+    
+    embeddings.unindex_item(item_id)
@@ -4,11 +4,22 @@ Router API per gestione Locations (scatole, scaffali, stanze).
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from pydantic import BaseModel
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from ..database import get_db, Location
+from ..database import get_db, Item, Location
+from ..services.location_hierarchy import (
+    ancestors, child_path, empty_counts, item_counts, location_exists,
+    location_tree, move_subtree, path_for, restore_subtree,
+    soft_delete_subtree
+)
+from ..services.search_cache import (
+    bump_data_generation, data_generation, etag_matches
+)
+from .items import ItemResponse, ItemsList
+from ..services.suggest_index import suggest_index
 
 
 router = APIRouter(prefix="/locations", tags=["locations"])
@@ -30,6 +41,14 @@ class LocationUpdate(BaseModel):
     parent_id: Optional[int] = None
 
 
+class ItemCounts(BaseModel):
+    """Items della location per stato (in mano = presi da qui)."""
+    available: int = 0
+    in_hand: int = 0
+    loaned: int = 0
+    lost: int = 0
+
+
 class LocationResponse(BaseModel):
     """Schema risposta location."""
     id: int
@@ -37,15 +56,42 @@ class LocationResponse(BaseModel):
     description: Optional[str]
     parent_id: Optional[int]
     item_count: int
+    item_counts: ItemCounts = ItemCounts()
     created_at: datetime
     
     class Config:
         from_attributes = True
 
 
+class Breadcrumb(BaseModel):
+    """Antenato di una location (per il breadcrumb)."""
+    id: int
+    name: str
+
+
 class LocationDetail(LocationResponse):
     """Schema risposta dettaglio con parent info."""
     parent_name: Optional[str] = None
+    breadcrumb: List[Breadcrumb] = []  # Antenati dalla radice al parent
+
+
+class LocationTreeNode(LocationResponse):
+    """Nodo dell'albero locations con conteggi cumulativi del sottoalbero."""
+    depth: int  # 0 = radice dell'albero richiesto
+    path: str   # Nomi degli antenati separati da " / "
+    subtree_item_count: int          # item_count di location + discendenti
+    subtree_item_counts: ItemCounts  # item_counts di location + discendenti
+    children: List["LocationTreeNode"] = []
+
+
+LocationTreeNode.model_rebuild()
+
+
+class LocationOverview(BaseModel):
+    """Pagina QR di una location: dettaglio, sotto-locations e items."""
+    location: LocationDetail
+    children: List[LocationResponse]
+    items: ItemsList  # Prima pagina, più recenti prima
 
 
 # ============== API Endpoints ==============
@@ -59,7 +105,8 @@ def list_locations(
     """
     Lista tutte le locations.
     Filtra per parent_id se specificato.
-    Include conteggio items per location.
+    Include conteggio items per location (un solo GROUP BY per
+    tutta la lista, con suddivisione per stato).
     """
     query = db.query(Location)
     
@@ -71,18 +118,100 @@ def list_locations(
     
     locations = query.order_by(Location.name).all()
     
+    # Conteggi di tutte le locations della lista in una sola query
+    counts = item_counts(
+        db,
+        None if parent_id is None else [loc.id for loc in locations]
+    )
+    
     # Costruisci risposta con item_count
-    return [
-        LocationResponse(
+    responses = []
+    for loc in locations:
+        loc_counts = counts.get(loc.id) or empty_counts()
+        responses.append(LocationResponse(
             id=loc.id,
             name=loc.name,
             description=loc.description,
             parent_id=loc.parent_id,
-            item_count=loc.item_count,
+            item_count=loc_counts["total"],
+            item_counts=ItemCounts(**loc_counts),
             created_at=loc.created_at
+        ))
+    return responses
+
+
+@router.get("/tree", response_model=List[LocationTreeNode])
+def get_location_tree(
+    root_id: Optional[int] = Query(None, description="Radice del sottoalbero (default: tutto)"),
+    max_depth: Optional[int] = Query(None, ge=0, description="Profondità massima restituita"),
+    db: Session = Depends(get_db)
+):
+    """
+    Gerarchia completa (o il sottoalbero di root_id) in una sola
+    richiesta: una CTE ricorsiva per le locations e un GROUP BY per
+    i conteggi, invece di una chiamata ?parent_id= per nodo.
+    Ogni nodo ha conteggi diretti e cumulativi del sottoalbero;
+    con max_depth i nodi più profondi non sono restituiti ma restano
+    inclusi nei conteggi cumulativi.
+    """
+    if root_id is not None and not location_exists(db, root_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Location {root_id} non trovata"
+        )
+    
+    rows = location_tree(db, root_id)
+    # Solo il sottoalbero restituito (anche oltre max_depth, per i cumulativi);
+    # per l'albero intero il GROUP BY senza filtro è già quello minimo
+    counts = item_counts(
+        db, [row.id for row in rows] if root_id is not None else None
+    )
+    
+    nodes = {}
+    roots = []
+    for row in rows:
+        if row.id in nodes:
+            continue  # Raggiungibile da più percorsi (dati incoerenti)
+        direct = counts.get(row.id) or empty_counts()
+        node = LocationTreeNode(
+            id=row.id,
+            name=row.name,
+            description=row.description,
+            parent_id=row.parent_id,
+            item_count=direct["total"],
+            item_counts=ItemCounts(**direct),
+            created_at=row.created_at,
+            depth=row.depth,
+            path=row.path,
+            subtree_item_count=direct["total"],
+            subtree_item_counts=ItemCounts(**direct)
         )
-        for loc in locations
-    ]
+        nodes[row.id] = node
+        parent = nodes.get(row.parent_id) if row.depth > 0 else None
+        if parent is None:
+            roots.append(node)
+        else:
+            parent.children.append(node)
+    
+    # Conteggi cumulativi: dalle foglie verso la radice (righe per profondità)
+    for node in reversed(list(nodes.values())):
+        parent = nodes.get(node.parent_id) if node.depth > 0 else None
+        if parent is None:
+            continue
+        parent.subtree_item_count += node.subtree_item_count
+        for key in ItemCounts.model_fields:
+            setattr(
+                parent.subtree_item_counts, key,
+                getattr(parent.subtree_item_counts, key)
+                + getattr(node.subtree_item_counts, key)
+            )
+    
+    if max_depth is not None:
+        for node in nodes.values():
+            if node.depth == max_depth:
+                node.children = []
+    
+    return roots
 
 
 @router.get("/{location_id}", response_model=LocationDetail)
@@ -93,6 +222,8 @@ def get_location(
     """
     Ottiene una singola location per ID.
     Usato per Deep Linking da QR code.
+    Il breadcrumb viene dal percorso materializzato (una lookup per
+    chiave, nessuna risalita di parent_id).
     """
     location = db.query(Location).filter(
         Location.id == location_id,
@@ -105,21 +236,142 @@ def get_location(
             detail=f"Location {location_id} non trovata"
         )
     
+    breadcrumb = ancestors(db, location.id)
+    
     parent_name = None
-    if location.parent:
+    if breadcrumb and breadcrumb[-1][0] == location.parent_id:
+        parent_name = breadcrumb[-1][1]
+    elif location.parent:
         parent_name = location.parent.name
     
+    counts = item_counts(db, [location.id]).get(location.id) or empty_counts()
+    
     return LocationDetail(
         id=location.id,
         name=location.name,
         description=location.description,
         parent_id=location.parent_id,
         parent_name=parent_name,
-        item_count=location.item_count,
+        breadcrumb=[Breadcrumb(id=i, name=n) for i, n in breadcrumb],
+        item_count=counts["total"],
+        item_counts=ItemCounts(**counts),
         created_at=location.created_at
     )
 
 
+@router.get("/{location_id}/overview", response_model=LocationOverview)
+def get_location_overview(
+    location_id: int,
+    request: Request,
+    response: Response,
+    per_page: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """
+    Tutto quello che serve alla pagina /loc/:id (Deep Linking da QR)
+    in una sola richiesta: location con breadcrumb, sotto-locations
+    e prima pagina di items, con un numero fisso di query.
+    Risponde 304 se l'ETag (generazione dei dati) non è cambiato:
+    una nuova scansione della stessa scatola non rilegge il database.
+    """
+    etag = data_generation.etag("location", location_id, per_page)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    location = db.query(Location).filter(
+        Location.id == location_id,
+        Location.deleted_at.is_(None)
+    ).first()
+    
+    if not location:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Location {location_id} non trovata"
+        )
+    
+    # Breadcrumb dal percorso materializzato
+    breadcrumb = ancestors(db, location.id, path=location.path)
+    parent_name = None
+    if breadcrumb and breadcrumb[-1][0] == location.parent_id:
+        parent_name = breadcrumb[-1][1]
+    elif location.parent:
+        parent_name = location.parent.name
+    
+    children = db.query(Location).filter(
+        Location.parent_id == location.id,
+        Location.deleted_at.is_(None)
+    ).order_by(Location.name).all()
+    
+    # Conteggi di location e sotto-locations in un solo GROUP BY
+    counts = item_counts(db, [location.id] + [child.id for child in children])
+    
+    # Prima pagina di items con il totale (window function, una query);
+    # solo le colonne della risposta, senza il BLOB dell'embedding
+    rows = db.query(
+        Item.id,
+        Item.location_id,
+        Item.photo_path,
+        Item.thumbnail_path,
+        Item.description,
+        Item.status,
+        Item.created_at,
+        func.count().over().label("total")
+    ).filter(
+        Item.location_id == location.id,
+        Item.deleted_at.is_(None)
+    ).order_by(Item.created_at.desc()).limit(per_page).all()
+    
+    location_counts = counts.get(location.id) or empty_counts()
+    child_responses = []
+    for child in children:
+        child_counts = counts.get(child.id) or empty_counts()
+        child_responses.append(LocationResponse(
+            id=child.id,
+            name=child.name,
+            description=child.description,
+            parent_id=child.parent_id,
+            item_count=child_counts["total"],
+            item_counts=ItemCounts(**child_counts),
+            created_at=child.created_at
+        ))
+    
+    response.headers.update(headers)
+    
+    return LocationOverview(
+        location=LocationDetail(
+            id=location.id,
+            name=location.name,
+            description=location.description,
+            parent_id=location.parent_id,
+            parent_name=parent_name,
+            breadcrumb=[Breadcrumb(id=i, name=n) for i, n in breadcrumb],
+            item_count=location_counts["total"],
+            item_counts=ItemCounts(**location_counts),
+            created_at=location.created_at
+        ),
+        children=child_responses,
+        items=ItemsList(
+            items=[
+                ItemResponse(
+                    id=row.id,
+                    location_id=row.location_id,
+                    location_name=location.name,
+                    photo_path=row.photo_path,
+                    thumbnail_path=row.thumbnail_path,
+                    description=row.description,
+                    status=row.status,
+                    created_at=row.created_at
+                )
+                for row in rows
+            ],
+            total=rows[0].total if rows else 0,
+            page=1,
+            per_page=per_page
+        )
+    )
+
+
 @router.post("", response_model=LocationResponse, status_code=status.HTTP_201_CREATED)
 def create_location(
     data: LocationCreate,
@@ -148,8 +400,12 @@ def create_location(
     )
     
     db.add(location)
+    db.flush()  # ID necessario per il percorso materializzato
+    location.path = path_for(db, data.parent_id, location.id)
     db.commit()
+    bump_data_generation()
     db.refresh(location)
+    suggest_index.add(location.name)
     
     return LocationResponse(
         id=location.id,
@@ -178,19 +434,27 @@ def claim_location(
     
     if existing:
         if existing.deleted_at:
-            # Riattiva location soft-deleted
-            existing.deleted_at = None
+            # Riattiva location soft-deleted con quanto eliminato insieme
+            locations, items = _restore_subtree(db, existing)
             existing.name = data.name
             existing.description = data.description
             db.commit()
+            bump_data_generation()
             db.refresh(existing)
+            for restored_id, name in locations:
+                if restored_id != existing.id:
+                    suggest_index.add(name)
+            suggest_index.add(existing.name)
+            _reindex_restored(items)
         
+        counts = item_counts(db, [existing.id]).get(existing.id) or empty_counts()
         return LocationResponse(
             id=existing.id,
             name=existing.name,
             description=existing.description,
             parent_id=existing.parent_id,
-            item_count=existing.item_count,
+            item_count=counts["total"],
+            item_counts=ItemCounts(**counts),
             created_at=existing.created_at
         )
     
@@ -199,18 +463,21 @@ def claim_location(
     try:
         db.execute(
             text("""
-                INSERT INTO locations (id, name, description, parent_id, created_at)
-                VALUES (:id, :name, :description, :parent_id, :created_at)
+                INSERT INTO locations (id, name, description, parent_id, path, created_at)
+                VALUES (:id, :name, :description, :parent_id, :path, :created_at)
             """),
             {
                 "id": location_id,
                 "name": data.name,
                 "description": data.description,
                 "parent_id": data.parent_id,
+                "path": path_for(db, data.parent_id, location_id),
                 "created_at": datetime.utcnow()
             }
         )
         db.commit()
+        bump_data_generation()
+        suggest_index.add(data.name)
     except Exception as e:
         db.rollback()
         raise HTTPException(
@@ -237,7 +504,12 @@ def update_location(
     data: LocationUpdate,
     db: Session = Depends(get_db)
 ):
-    """Aggiorna una location esistente."""
+    """
+    Aggiorna una location esistente.
+    Cambiando parent_id si sposta l'intero sottoalbero (percorsi
+    riscritti con un solo UPDATE); 400 se il nuovo parent non esiste
+    o è la location stessa / una sua discendente.
+    """
     location = db.query(Location).filter(
         Location.id == location_id,
         Location.deleted_at.is_(None)
@@ -249,22 +521,36 @@ def update_location(
             detail="Location non trovata"
         )
     
+    old_name = location.name
+    
     if data.name is not None:
         location.name = data.name
     if data.description is not None:
         location.description = data.description
-    if data.parent_id is not None:
-        location.parent_id = data.parent_id
+    if data.parent_id is not None and data.parent_id != location.parent_id:
+        try:
+            move_subtree(db, location, data.parent_id)
+        except ValueError as e:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
     
     db.commit()
+    bump_data_generation()
     db.refresh(location)
+    suggest_index.replace(old_name, location.name)
+    
+    counts = item_counts(db, [location.id]).get(location.id) or empty_counts()
     
     return LocationResponse(
         id=location.id,
         name=location.name,
         description=location.description,
         parent_id=location.parent_id,
-        item_count=location.item_count,
+        item_count=counts["total"],
+        item_counts=ItemCounts(**counts),
         created_at=location.created_at
     )
 
@@ -275,9 +561,13 @@ def delete_location(
     db: Session = Depends(get_db)
 ):
     """
-    Soft delete di una location.
-    Gli items vengono automaticamente orfanizzati (location_id = NULL).
+    Soft delete di una location con tutte le sue sotto-locations e i
+    loro items, in una transazione: un UPDATE per tabella sul range
+    del percorso materializzato, anche con migliaia di items.
+    Tutte le righe ricevono lo stesso deleted_at, usato dal ripristino.
     """
+    from ..services import embeddings
+    
     location = db.query(Location).filter(
         Location.id == location_id,
         Location.deleted_at.is_(None)
@@ -289,5 +579,88 @@ def delete_location(
             detail="Location non trovata"
         )
     
-    location.deleted_at = datetime.utcnow()
+    locations, items = soft_delete_subtree(
+        db,
+        location.path or child_path(None, location.id),
+        datetime.utcnow()
+    )
+    db.commit()
+    bump_data_generation()
+    
+    for _, name in locations:
+        suggest_index.remove(name)
+    for item_id, description in items:
+        suggest_index.remove(description)
+        embeddings.unindex_item(item_id)
+
+
+@router.post("/{location_id}/restore", response_model=LocationResponse)
+def restore_location(
+    location_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Ripristina una location eliminata insieme alle sotto-locations e
+    agli items eliminati con lei (stesso deleted_at); ciò che era già
+    stato eliminato prima resta eliminato.
+    """
+    location = db.query(Location).filter(
+        Location.id == location_id,
+        Location.deleted_at.isnot(None)
+    ).first()
+    
+    if not location:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Location eliminata non trovata"
+        )
+    
+    locations, items = _restore_subtree(db, location)
     db.commit()
+    bump_data_generation()
+    db.refresh(location)
+    
+    for _, name in locations:
+        suggest_index.add(name)
+    _reindex_restored(items)
+    
+    counts = item_counts(db, [location.id]).get(location.id) or empty_counts()
+    
+    return LocationResponse(
+        id=location.id,
+        name=location.name,
+        description=location.description,
+        parent_id=location.parent_id,
+        item_count=counts["total"],
+        item_counts=ItemCounts(**counts),
+        created_at=location.created_at
+    )
+
+
+def _restore_subtree(db: Session, location: Location):
+    """Ripristina il sottoalbero (senza commit); ritorna (locations, items)."""
+    return restore_subtree(
+        db,
+        location.id,
+        location.path or child_path(None, location.id)
+    )
+
+
+def _reindex_restored(items):
+    """
+    Dopo il commit di un ripristino: items di nuovo nell'indice
+    semantico e nell'autocompletamento (i nomi delle locations li
+    gestisce il chiamante), worker svegliato per i PENDING.
+    """
+    from ..services import embeddings
+    from ..services.embedding_worker import embedding_worker
+    
+    pending = False
+    for item_id, description, blob, embedding_status in items:
+        suggest_index.add(description)
+        if embedding_status == "READY":
+            embeddings.index_item(item_id, blob)
+        elif embedding_status == "PENDING":
+            pending = True
+    if pending:
+        embedding_worker.notify()
@@ -1,16 +1,29 @@
 """
-Router API per ricerca con supporto Semantic Search (OpenAI embeddings).
-Fallback a FTS5 se OpenAI non disponibile.
+Router API per ricerca con supporto Semantic Search (embeddings).
+Fallback a FTS5 se il provider di embeddings non è disponibile.
 """
-from typing import List, Optional
+import re
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Set, Tuple
 
-from fastapi import APIRouter, Depends, Query
-from pydantic import BaseModel
-from sqlalchemy import text
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from pydantic import BaseModel, Field
+from sqlalchemy import bindparam, func, text
 from sqlalchemy.orm import Session
 
-from ..database import get_db, Item, ItemStatus, Location
+from ..config import settings
+from ..database import get_db, Item, ItemStatus, EmbeddingStatus, Location
 from ..services import embeddings
+from ..services.embedding_cache import normalize_text
+from ..services.fuzzy_search import fuzzy_vocabulary
+from ..services.location_hierarchy import (
+    item_ids_in_locations, subtree_location_ids
+)
+from ..services.search_cache import (
+    bump_data_generation, data_generation, search_cache
+)
+from ..services.suggest_index import suggest_index
 
 
 router = APIRouter(prefix="/search", tags=["search"])
@@ -27,6 +40,8 @@ class SearchResult(BaseModel):
     description: Optional[str]
     status: ItemStatus
     rank: float  # Relevance score
+    fts_score: Optional[float] = None       # Solo hybrid: punteggio bm25
+    semantic_score: Optional[float] = None  # Solo hybrid: similarità coseno
     
     class Config:
         from_attributes = True
@@ -37,7 +52,35 @@ class SearchResponse(BaseModel):
     query: str
     results: List[SearchResult]
     total: int
-    method: str  # "semantic", "fts", "like"
+    method: str  # "semantic", "fts", "like", "hybrid"
+    cache: str = "miss"  # "hit", "miss", "bypass"
+    partial: bool = False  # True se la semantica ha sforato il budget (solo FTS5)
+
+
+class BatchSearchRequest(BaseModel):
+    """Schema richiesta ricerca batch."""
+    queries: List[str] = Field(
+        ..., min_length=1, max_length=settings.SEARCH_BATCH_MAX_QUERIES
+    )
+    limit: int = Field(10, ge=1, le=50)
+
+
+class BatchSearchResponse(BaseModel):
+    """Schema risposta ricerca batch: una SearchResponse per query."""
+    results: List[SearchResponse]
+
+
+class Suggestion(BaseModel):
+    """Completamento proposto dalla barra di ricerca."""
+    text: str   # Query completa proposta
+    term: str   # Termine che completa l'ultima parola
+    count: int  # Occorrenze del termine (items + locations)
+
+
+class SuggestResponse(BaseModel):
+    """Schema risposta autocompletamento."""
+    query: str
+    suggestions: List[Suggestion]
 
 
 # ============== API Endpoints ==============
@@ -46,82 +89,340 @@ class SearchResponse(BaseModel):
 def search_items(
     q: str = Query(..., min_length=1, description="Query di ricerca"),
     limit: int = Query(20, ge=1, le=50),
+    method: str = Query(
+        "auto",
+        pattern="^(auto|hybrid|semantic|fts|like)$",
+        description="auto: semantica con fallback FTS5/LIKE; hybrid: fusione RRF"
+    ),
+    fts_weight: Optional[float] = Query(None, ge=0, description="Peso FTS5 (hybrid)"),
+    semantic_weight: Optional[float] = Query(None, ge=0, description="Peso semantico (hybrid)"),
+    location_id: Optional[int] = Query(None, description="Cerca solo in questa location"),
+    include_descendants: bool = Query(True, description="Includi le sotto-locations"),
     db: Session = Depends(get_db)
 ):
     """
     Ricerca items per descrizione.
-    Usa ricerca semantica (OpenAI) se disponibile, altrimenti FTS5.
+    Usa ricerca semantica (embeddings) se disponibile, altrimenti FTS5.
+    Con method=hybrid esegue FTS5 e semantica insieme e fonde le
+    classifiche con Reciprocal Rank Fusion.
+    In auto/hybrid l'embedding della query è calcolato in parallelo
+    a FTS5: se non arriva entro SEARCH_SEMANTIC_BUDGET_MS si
+    rispondono i soli risultati FTS5 con partial=true.
+    Con location_id la ricerca è limitata alla location (e alle sue
+    discendenti se include_descendants): il filtro è applicato dentro
+    FTS5 e l'indice semantico, non sul top-k globale.
     """
     if not q.strip():
-        return SearchResponse(query=q, results=[], total=0, method="none")
+        return SearchResponse(query=q, results=[], total=0, method="none", cache="bypass")
+    
+    if fts_weight is None:
+        fts_weight = settings.HYBRID_FTS_WEIGHT
+    if semantic_weight is None:
+        semantic_weight = settings.HYBRID_SEMANTIC_WEIGHT
+    
+    # Cache risultati: chiave = query normalizzata + parametri
+    scope = (location_id, include_descendants) if location_id is not None else None
+    cache_key = (normalize_text(q), limit, method, fts_weight, semantic_weight, scope)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached.model_copy(update={"query": q, "cache": "hit"})
+    
+    generation = data_generation.value
+    location_ids = None
+    if location_id is not None:
+        location_ids = subtree_location_ids(db, location_id, include_descendants)
+        if not location_ids:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Location non trovata"
+            )
+    
+    result = _run_search(
+        q, limit, method, fts_weight, semantic_weight, db,
+        location_ids=location_ids
+    )
+    if not result.partial:
+        search_cache.put(cache_key, result, generation)
+    return result
+
+
+def _run_search(
+    q: str,
+    limit: int,
+    method: str,
+    fts_weight: float,
+    semantic_weight: float,
+    db: Session,
+    location_ids: Optional[List[int]] = None
+) -> SearchResponse:
+    """
+    Esegue la ricerca con il metodo richiesto (senza cache).
+    location_ids: se indicato, solo items in queste locations.
+    """
+    deadline = _semantic_deadline()
+    
+    if method == "hybrid":
+        return _search_hybrid(
+            q, limit, db,
+            fts_weight=fts_weight,
+            semantic_weight=semantic_weight,
+            deadline=deadline,
+            location_ids=location_ids
+        )
+    if method == "semantic":
+        return _search_semantic(q, limit, db, location_ids=location_ids)
+    if method == "fts":
+        return _search_fts5(q, limit, db, location_ids=location_ids)
+    if method == "like":
+        return _search_like(q, limit, db, location_ids=location_ids)
+    
+    # Embedding della query in background mentre gira FTS5
+    pending_embedding = _start_query_embedding(q)
+    
+    try:
+        fts_hits = _fts5_hits(q, limit, db, location_ids=location_ids)
+    except Exception:
+        fts_hits = None  # Sintassi FTS non valida
     
-    # Prova ricerca semantica se disponibile
+    # Ricerca semantica se l'embedding arriva entro il budget
+    timed_out = False
+    if pending_embedding is not None:
+        query_embedding, timed_out = _await_query_embedding(pending_embedding, deadline)
+        if query_embedding is not None:
+            item_ids = None
+            if location_ids is not None:
+                item_ids = item_ids_in_locations(db, location_ids)
+            semantic_hits = _semantic_hits(
+                q, limit,
+                query_embedding=query_embedding,
+                item_ids=item_ids
+            )
+            result = _with_pending_fts(q, limit, db, semantic_hits, fts_hits or [])
+            if result.total > 0:
+                return result
+    
+    # Fallback a FTS5 (parziale se la semantica è ancora in corso)
+    if fts_hits is not None:
+        results = _hydrate_results(db, fts_hits)
+        return SearchResponse(
+            query=q,
+            results=results,
+            total=len(results),
+            method="fts",
+            partial=timed_out
+        )
+    
+    # Ultimo fallback a LIKE
+    return _search_like(q, limit, db, location_ids=location_ids)
+
+
+@router.get("/suggest", response_model=SuggestResponse)
+def suggest(
+    q: str = Query(..., min_length=1, description="Testo digitato finora"),
+    limit: int = Query(8, ge=1, le=20)
+):
+    """
+    Autocompletamento per la barra di ricerca (typeahead).
+    Completa l'ultima parola con i termini più frequenti di descrizioni
+    e nomi delle locations, da un indice in memoria: nessuna query
+    SQLite né chiamata al provider di embeddings.
+    """
+    head, _, last = q.rstrip().rpartition(" ")
+    if not last or q != q.rstrip():
+        # Parola appena conclusa: niente da completare
+        return SuggestResponse(query=q, suggestions=[])
+    
+    prefix = f"{head} " if head else ""
+    return SuggestResponse(
+        query=q,
+        suggestions=[
+            Suggestion(text=prefix + term, term=term, count=count)
+            for term, count in suggest_index.suggest(last, limit)
+        ]
+    )
+
+
+@router.post("/batch", response_model=BatchSearchResponse)
+def search_batch(
+    data: BatchSearchRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Ricerca di più descrizioni in una sola richiesta (automazioni:
+    liste della spesa, inventari). Gli embeddings di tutte le query
+    sono generati con una sola chiamata al provider e confrontati con
+    l'indice in un unico prodotto matrice-matrice; le query senza
+    risultati semantici (o senza provider) passano a FTS5.
+    Una sola query di hydration per tutti i risultati.
+    """
+    queries = [q.strip() for q in data.queries]
+    hits: Dict[int, Tuple[List[Tuple[int, float]], str]] = {}
+    
+    # Semantica: un batch di embeddings + un prodotto matrice-matrice
     if embeddings.is_semantic_search_available():
-        result = _search_semantic(q, limit, db)
-        if result.total > 0:
-            return result
+        vectors = embeddings.generate_embeddings(queries)
+        embedded = [i for i, vector in enumerate(vectors) if vector is not None]
+        if embedded:
+            semantic = embeddings.search_many_by_similarity(
+                [vectors[i] for i in embedded],
+                threshold=0.3,
+                limit=data.limit
+            )
+            for i, query_hits in zip(embedded, semantic):
+                if query_hits:
+                    hits[i] = (query_hits, "semantic")
+    
+    # Fallback FTS5 per le query rimaste senza risultati
+    for i, q in enumerate(queries):
+        if i in hits:
+            continue
+        try:
+            hits[i] = (_fts5_hits(q, data.limit, db) if q else [], "fts")
+        except Exception:
+            hits[i] = ([], "fts")
+    
+    item_ids = list(dict.fromkeys(
+        item_id for query_hits, _ in hits.values() for item_id, _ in query_hits
+    ))
+    hydrated = {
+        result.id: result
+        for result in _hydrate_results(db, [(item_id, 0.0) for item_id in item_ids])
+    }
     
-    # Fallback a FTS5
+    responses = []
+    for i, q in enumerate(data.queries):
+        query_hits, method = hits[i]
+        results = [
+            hydrated[item_id].model_copy(update={"rank": score})
+            for item_id, score in query_hits
+            if item_id in hydrated
+        ]
+        responses.append(SearchResponse(
+            query=q,
+            results=results,
+            total=len(results),
+            method=method,
+            cache="bypass"
+        ))
+    
+    return BatchSearchResponse(results=responses)
+
+
+# ============== Budget semantico ==============
+
+def _semantic_deadline() -> Optional[float]:
+    """Istante (monotonic) oltre cui non si attende la semantica; None = nessun limite."""
+    if settings.SEARCH_SEMANTIC_BUDGET_MS <= 0:
+        return None
+    return time.monotonic() + settings.SEARCH_SEMANTIC_BUDGET_MS / 1000
+
+
+def _start_query_embedding(q: str) -> Optional[Future]:
+    """Avvia l'embedding della query in background (None se non disponibile)."""
+    if not embeddings.is_semantic_search_available():
+        return None
+    return embeddings.submit_query_embedding(q)
+
+
+def _await_query_embedding(
+    pending: Future,
+    deadline: Optional[float]
+) -> Tuple[Optional[object], bool]:
+    """
+    Attende l'embedding della query fino alla deadline.
+    Ritorna (embedding o None, True se il budget è scaduto).
+    A budget scaduto il calcolo prosegue e finisce comunque in cache.
+    """
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
     try:
-        return _search_fts5(q, limit, db)
+        return pending.result(timeout=timeout), False
+    except FutureTimeout:
+        return None, True
     except Exception:
-        # Ultimo fallback a LIKE
-        return _search_like(q, limit, db)
+        return None, False
 
 
 def _search_semantic(
     q: str, 
     limit: int, 
-    db: Session
+    db: Session,
+    query_embedding=None,
+    location_ids: Optional[List[int]] = None
 ) -> SearchResponse:
-    """Ricerca semantica usando embeddings OpenAI."""
+    """Ricerca semantica usando gli embeddings del provider configurato."""
     
-    # Genera embedding della query
-    query_embedding = embeddings.generate_embedding(q)
-    if not query_embedding:
-        return SearchResponse(query=q, results=[], total=0, method="semantic")
+    item_ids = None
+    if location_ids is not None:
+        item_ids = item_ids_in_locations(db, location_ids)
+    similar_items = _semantic_hits(
+        q, limit,
+        query_embedding=query_embedding,
+        item_ids=item_ids
+    )
+    results = _hydrate_results(db, similar_items)
     
-    # Prendi tutti gli items con embedding
-    items_with_embeddings = db.query(Item.id, Item.embedding).filter(
-        Item.deleted_at.is_(None),
-        Item.embedding.isnot(None)
-    ).all()
+    return SearchResponse(
+        query=q,
+        results=results,
+        total=len(results),
+        method="semantic"
+    )
+
+
+def _semantic_hits(
+    q: str,
+    limit: int,
+    query_embedding=None,
+    item_ids: Optional[List[int]] = None
+) -> List[Tuple[int, float]]:
+    """
+    Top-k semantico dall'indice in memoria: [(item_id, similarità), ...].
+    query_embedding: già calcolato (es. in parallelo a FTS5).
+    item_ids: valuta solo questi items (ricerca in un sottoalbero).
+    """
+    if item_ids is not None and not item_ids:
+        return []
     
-    if not items_with_embeddings:
-        return SearchResponse(query=q, results=[], total=0, method="semantic")
+    # Genera embedding della query
+    if query_embedding is None:
+        query_embedding = embeddings.generate_embedding(q)
+    if query_embedding is None:
+        return []
     
-    # Cerca per similarità
-    similar_items = embeddings.search_by_similarity(
+    # Cerca per similarità nell'indice in memoria
+    return embeddings.search_by_similarity(
         query_embedding,
-        [(item.id, item.embedding) for item in items_with_embeddings],
         threshold=0.3,
-        limit=limit
+        limit=limit,
+        item_ids=item_ids
     )
-    
-    if not similar_items:
+
+
+def _with_pending_fts(
+    q: str,
+    limit: int,
+    db: Session,
+    semantic_hits: List[Tuple[int, float]],
+    fts_hits: List[Tuple[int, float]]
+) -> SearchResponse:
+    """
+    Risultati semantici completati con gli items ancora senza embedding
+    (PENDING o FAILED) trovati da FTS5 (altrimenti sarebbero invisibili).
+    Si ricavano dagli fts_hits già calcolati, filtrando lo stato nella
+    stessa query di hydration: nessuna seconda MATCH.
+    """
+    if not semantic_hits:
         return SearchResponse(query=q, results=[], total=0, method="semantic")
     
-    # Costruisci risultati
-    results = []
-    for item_id, similarity in similar_items:
-        item = db.query(Item).filter(Item.id == item_id).first()
-        if not item:
-            continue
-        
-        loc_name = None
-        if item.location:
-            loc_name = item.location.name
-        
-        results.append(SearchResult(
-            id=item.id,
-            location_id=item.location_id,
-            location_name=loc_name,
-            thumbnail_path=item.thumbnail_path,
-            description=item.description,
-            status=item.status,
-            rank=similarity
-        ))
+    extra = []
+    if len(semantic_hits) < limit:
+        seen = {item_id for item_id, _ in semantic_hits}
+        extra = [(item_id, score) for item_id, score in fts_hits if item_id not in seen]
     
+    results = _hydrate_results(
+        db, semantic_hits + extra,
+        pending_only={item_id for item_id, _ in extra}
+    )[:limit]
     return SearchResponse(
         query=q,
         results=results,
@@ -133,91 +434,201 @@ def _search_semantic(
 def _search_fts5(
     q: str, 
     limit: int, 
-    db: Session
+    db: Session,
+    location_ids: Optional[List[int]] = None
 ) -> SearchResponse:
-    """Ricerca full-text usando FTS5."""
+    """
+    Ricerca full-text usando FTS5.
+    location_ids: solo items in queste locations.
+    """
+    hits = _fts5_hits(
+        q, limit, db,
+        location_ids=location_ids
+    )
+    results = _hydrate_results(db, hits)
     
-    # Prepara query per FTS5 con prefix matching
-    search_terms = " ".join(f"{term}*" for term in q.split())
+    return SearchResponse(
+        query=q,
+        results=results,
+        total=len(results),
+        method="fts"
+    )
+
+
+def _fts5_hits(
+    q: str,
+    limit: int,
+    db: Session,
+    location_ids: Optional[List[int]] = None
+) -> List[Tuple[int, float]]:
+    """
+    Top-k FTS5: [(item_id, |bm25|), ...] in ordine di rilevanza.
+    location_ids: filtro nella stessa query, prima del LIMIT.
+    """
+    if location_ids is not None and not location_ids:
+        return []
+    
+    # Termini sconosciuti (typo) -> termine indicizzato più vicino
+    try:
+        q = fuzzy_vocabulary.rewrite(q, db)
+    except Exception as e:
+        print(f"Errore correzione fuzzy: {e}")
+    
+    # Prepara query per FTS5 (termini quotati, prefix matching)
+    search_terms = _fts5_query(q)
+    if not search_terms:
+        return []
     
-    sql = text("""
+    location_filter = (
+        "AND items.location_id IN :location_ids" if location_ids is not None else ""
+    )
+    sql = text(f"""
         SELECT 
             items.id,
-            items.location_id,
-            items.thumbnail_path,
-            items.description,
-            items.status,
             items_fts.rank
         FROM items_fts
         JOIN items ON items_fts.rowid = items.id
         WHERE items_fts MATCH :query
           AND items.deleted_at IS NULL
+          {location_filter}
         ORDER BY items_fts.rank
         LIMIT :limit
     """)
+    params = {"query": search_terms, "limit": limit}
+    if location_ids is not None:
+        sql = sql.bindparams(bindparam("location_ids", expanding=True))
+        params["location_ids"] = location_ids
     
-    result = db.execute(sql, {"query": search_terms, "limit": limit})
-    rows = result.fetchall()
+    result = db.execute(sql, params)
+    return [(row.id, abs(row.rank)) for row in result]
+
+
+_WORD = re.compile(r"\w", re.UNICODE)
+
+
+def _fts5_query(q: str) -> str:
+    """
+    Converte il testo utente in una query FTS5 sicura: ogni termine è
+    una stringa quotata (virgolette raddoppiate), così operatori e
+    caratteri speciali (AND, -, ", *, :) non causano errori di sintassi.
+    I termini senza caratteri alfanumerici vengono scartati.
+    - unicode61: prefix query "term"* (servite dagli indici prefix)
+    - trigram: sottostringhe, servono almeno 3 caratteri
+    """
+    terms = [term for term in q.split() if _WORD.search(term)]
+    if settings.FTS_TOKENIZER == "trigram":
+        terms = [term for term in terms if len(term) >= 3]
+        suffix = ""
+    else:
+        suffix = "*"
     
-    results = []
-    for row in rows:
-        loc_name = None
-        if row.location_id:
-            loc = db.query(Location).filter(Location.id == row.location_id).first()
-            if loc:
-                loc_name = loc.name
-        
-        # Handle both uppercase and lowercase status values
-        status_value = row.status
-        if isinstance(status_value, str):
-            status_value = status_value.lower()
-        else:
-            status_value = status_value.value
-        
-        results.append(SearchResult(
-            id=row.id,
-            location_id=row.location_id,
-            location_name=loc_name,
-            thumbnail_path=row.thumbnail_path,
-            description=row.description,
-            status=ItemStatus(status_value),
-            rank=abs(row.rank)
-        ))
+    return " ".join(
+        '"{}"{}'.format(term.replace('"', '""'), suffix) for term in terms
+    )
+
+
+def _search_hybrid(
+    q: str,
+    limit: int,
+    db: Session,
+    fts_weight: float,
+    semantic_weight: float,
+    deadline: Optional[float] = None,
+    location_ids: Optional[List[int]] = None
+) -> SearchResponse:
+    """
+    Ricerca ibrida: FTS5 e semantica nello stesso passaggio, fuse con
+    Reciprocal Rank Fusion. Le corrispondenze esatte (modelli, marche)
+    restano in cima anche se la similarità semantica è bassa.
+    Una sola query di hydration per tutti i risultati fusi.
+    L'embedding della query è calcolato in parallelo a FTS5; oltre la
+    deadline si fondono solo i risultati FTS5 (partial).
+    """
+    depth = min(max(limit * 3, 30), 150)  # Candidati per metodo
+    pending_embedding = _start_query_embedding(q)
+    
+    try:
+        fts_hits = _fts5_hits(q, depth, db, location_ids=location_ids)
+    except Exception:
+        fts_hits = []  # Sintassi FTS non valida: solo semantica
+    
+    semantic_hits = []
+    timed_out = False
+    if pending_embedding is not None:
+        query_embedding, timed_out = _await_query_embedding(pending_embedding, deadline)
+        if query_embedding is not None:
+            item_ids = None
+            if location_ids is not None:
+                item_ids = item_ids_in_locations(db, location_ids)
+            semantic_hits = _semantic_hits(
+                q, depth,
+                query_embedding=query_embedding,
+                item_ids=item_ids
+            )
+    
+    fused = _reciprocal_rank_fusion(
+        {"fts": fts_hits, "semantic": semantic_hits},
+        {"fts": fts_weight, "semantic": semantic_weight},
+        k=settings.HYBRID_RRF_K
+    )[:limit]
+    
+    results = _hydrate_results(
+        db,
+        [(item_id, score) for item_id, score, _ in fused],
+        method_scores={item_id: scores for item_id, _, scores in fused}
+    )
     
     return SearchResponse(
         query=q,
         results=results,
         total=len(results),
-        method="fts"
+        method="hybrid",
+        partial=timed_out
     )
 
 
+def _reciprocal_rank_fusion(
+    rankings: Dict[str, List[Tuple[int, float]]],
+    weights: Dict[str, float],
+    k: int = 60
+) -> List[Tuple[int, float, Dict[str, float]]]:
+    """
+    Reciprocal Rank Fusion: score(d) = sum_m w_m / (k + rank_m(d)).
+    Ritorna [(item_id, score fuso, {metodo: score originale}), ...]
+    ordinato per score fuso decrescente.
+    """
+    fused: Dict[int, float] = {}
+    method_scores: Dict[int, Dict[str, float]] = {}
+    
+    for method, hits in rankings.items():
+        weight = weights.get(method, 1.0)
+        for position, (item_id, score) in enumerate(hits, start=1):
+            fused[item_id] = fused.get(item_id, 0.0) + weight / (k + position)
+            method_scores.setdefault(item_id, {})[method] = score
+    
+    ordered = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return [(item_id, score, method_scores[item_id]) for item_id, score in ordered]
+
+
 def _search_like(
     q: str, 
     limit: int, 
-    db: Session
+    db: Session,
+    location_ids: Optional[List[int]] = None
 ) -> SearchResponse:
     """Ricerca fallback con LIKE."""
     
     search_pattern = f"%{q}%"
     
-    items = db.query(Item).filter(
+    query = db.query(Item.id).filter(
         Item.description.ilike(search_pattern),
         Item.deleted_at.is_(None)
-    ).limit(limit).all()
+    )
+    if location_ids is not None:
+        query = query.filter(Item.location_id.in_(location_ids))
+    rows = query.limit(limit).all()
     
-    results = []
-    for item in items:
-        loc_name = item.location.name if item.location else None
-        results.append(SearchResult(
-            id=item.id,
-            location_id=item.location_id,
-            location_name=loc_name,
-            thumbnail_path=item.thumbnail_path,
-            description=item.description,
-            status=item.status,
-            rank=1.0
-        ))
+    results = _hydrate_results(db, [(row.id, 1.0) for row in rows])
     
     return SearchResponse(
         query=q,
@@ -227,34 +638,214 @@ def _search_like(
     )
 
 
+# ============== Hydration ==============
+
+# Stati degli items non ancora nell'indice semantico
+_WITHOUT_EMBEDDING = (EmbeddingStatus.PENDING, EmbeddingStatus.FAILED)
+
+
+def _hydrate_results(
+    db: Session,
+    hits: List[Tuple[int, float]],
+    method_scores: Optional[Dict[int, Dict[str, float]]] = None,
+    pending_only: Optional[Set[int]] = None
+) -> List[SearchResult]:
+    """
+    Costruisce i SearchResult per una lista di (item_id, score) con
+    una sola query (items + nome location in LEFT JOIN), qualunque
+    sia il numero di risultati. Mantiene l'ordine di `hits` e scarta
+    gli items eliminati nel frattempo.
+    pending_only: ID da tenere solo se l'item è ancora senza embedding.
+    """
+    if not hits:
+        return []
+    
+    rows = db.query(
+        Item.id,
+        Item.location_id,
+        Item.thumbnail_path,
+        Item.description,
+        Item.status,
+        Item.embedding_status,
+        Location.name.label("location_name")
+    ).outerjoin(
+        Location, Location.id == Item.location_id
+    ).filter(
+        Item.id.in_([item_id for item_id, _ in hits]),
+        Item.deleted_at.is_(None)
+    ).all()
+    by_id = {row.id: row for row in rows}
+    
+    method_scores = method_scores or {}
+    pending_only = pending_only or set()
+    results = []
+    for item_id, score in hits:
+        row = by_id.get(item_id)
+        if row is None:
+            continue
+        if item_id in pending_only and row.embedding_status not in _WITHOUT_EMBEDDING:
+            continue
+        scores = method_scores.get(item_id, {})
+        results.append(SearchResult(
+            id=row.id,
+            location_id=row.location_id,
+            location_name=row.location_name,
+            thumbnail_path=row.thumbnail_path,
+            description=row.description,
+            status=row.status,
+            rank=score,
+            fts_score=scores.get("fts"),
+            semantic_score=scores.get("semantic")
+        ))
+    
+    return results
+
+
 # ============== Endpoint per rebuild embeddings ==============
 
 @router.post("/rebuild-embeddings")
-def rebuild_embeddings(db: Session = Depends(get_db)):
+def rebuild_embeddings(
+    force: bool = Query(False, description="Rigenera anche gli embeddings aggiornati"),
+    after_id: int = Query(0, ge=0, description="Riprendi dagli items con id > after_id"),
+    max_items: int = Query(2000, ge=1, le=50000, description="Items massimi per chiamata"),
+    db: Session = Depends(get_db)
+):
     """
-    Rigenera gli embeddings per tutti gli items.
-    Da usare dopo aggiornamento iniziale o per correzioni.
+    Rigenera gli embeddings degli items in batch.
+    - Items letti a pagine (keyset su id) fino a max_items da rigenerare
+    - Una chiamata API ogni EMBEDDING_BATCH_SIZE descrizioni
+    - Commit per batch: un'interruzione non perde il lavoro fatto
+    - Salta gli items il cui hash (modello + descrizione) non è cambiato
+    Ripetere la chiamata (con after_id = next_after_id) finché remaining = 0
+    (remaining: items con id > next_after_id ancora da esaminare).
     """
     if not embeddings.is_semantic_search_available():
-        return {"error": "OpenAI non configurato", "updated": 0}
+        return {"error": "Provider embeddings non disponibile", "updated": 0}
     
-    items = db.query(Item).filter(
-        Item.deleted_at.is_(None),
-        Item.description.isnot(None)
-    ).all()
+    batch_size = settings.EMBEDDING_BATCH_SIZE
+    scanned = skipped = updated = failed = 0
+    last_id = after_id
+    limit_reached = False
+    batch = []
     
-    updated = 0
-    for item in items:
-        if item.description:
-            embedding = embeddings.generate_embedding(item.description)
-            if embedding:
-                item.embedding = embeddings.embedding_to_json(embedding)
-                updated += 1
+    def flush():
+        nonlocal updated, failed
+        vectors = embeddings.generate_embeddings([d for _, d, _ in batch])
+        
+        mappings = []
+        for (item_id, _, description_hash), vector in zip(batch, vectors):
+            if vector is None:
+                failed += 1
+                continue
+            mappings.append({
+                "id": item_id,
+                "embedding": embeddings.embedding_to_blob(vector),
+                "embedding_hash": description_hash,
+                "embedding_model": embeddings.current_model(),
+                "embedding_status": EmbeddingStatus.READY,
+                "embedding_attempts": 0
+            })
+        batch.clear()
+        
+        if mappings:
+            db.bulk_update_mappings(Item, mappings)
+            db.commit()
+            bump_data_generation()
+            for mapping in mappings:
+                embeddings.index_item(mapping["id"], mapping["embedding"])
+            updated += len(mappings)
     
-    db.commit()
+    # Solo items con descrizione modificata (o senza embedding)
+    for row in _items_with_description(db, after_id, page_size=batch_size):
+        scanned += 1
+        last_id = row.id
+        description_hash = embeddings.content_hash(row.description)
+        if not force and row.embedding_hash == description_hash:
+            skipped += 1
+            continue
+        
+        batch.append((row.id, row.description, description_hash))
+        if len(batch) >= batch_size:
+            flush()
+        if updated + failed + len(batch) >= max_items:
+            limit_reached = True
+            break
+    if batch:
+        flush()
     
+    remaining = 0
+    if limit_reached:
+        remaining = _with_description(db.query(Item.id), last_id).count()
     return {
-        "message": f"Aggiornati {updated} embeddings su {len(items)} items",
+        "message": f"Aggiornati {updated} embeddings su {scanned} items",
         "updated": updated,
-        "total": len(items)
+        "failed": failed,
+        "skipped": skipped,
+        "remaining": remaining,
+        "next_after_id": last_id if remaining else None,
+        "total": scanned
     }
+
+
+def _with_description(query, after_id: int):
+    """Filtro comune: items attivi con descrizione e id > after_id."""
+    return query.filter(
+        Item.deleted_at.is_(None),
+        Item.description.isnot(None),
+        func.trim(Item.description) != "",
+        Item.id > after_id
+    )
+
+
+def _items_with_description(db: Session, after_id: int, page_size: int):
+    """
+    Items attivi con descrizione e id > after_id, in ordine di id,
+    letti a pagine di page_size righe (keyset: id > ultimo id letto):
+    in memoria c'è al più una pagina, non tutta la tabella.
+    """
+    last_id = after_id
+    while True:
+        rows = _with_description(
+            db.query(Item.id, Item.description, Item.embedding_hash), last_id
+        ).order_by(Item.id).limit(page_size).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+# ============== Endpoint per indice ANN ==============
+
+@router.post("/ann/rebuild")
+def rebuild_ann_index(nlist: Optional[int] = Query(None, ge=1)):
+    """
+    Riallena l'indice IVF sui vettori correnti (k-means).
+    Utile dopo una forte crescita dell'inventario.
+    """
+    if not settings.ANN_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Indice ANN disabilitato (ANN_ENABLED=false)"
+        )
+    
+    if not embeddings.train_ann_index(nlist):
+        return {"error": "Nessun embedding indicizzato", "nlist": 0}
+    
+    ivf = embeddings.embedding_index.ivf
+    return {"message": "Indice ANN ricostruito", "nlist": ivf.nlist}
+
+
+@router.get("/ann/recall")
+def ann_recall(
+    nprobe: Optional[int] = Query(None, ge=1),
+    k: int = Query(10, ge=1, le=100),
+    samples: int = Query(100, ge=1, le=1000)
+):
+    """
+    Misura recall@k dell'indice IVF rispetto al brute force.
+    Usare per tarare ANN_NPROBE (più alto = più recall, più latenza).
+    """
+    if embeddings.embedding_index.ivf is None:
+        return {"error": "Indice ANN non attivo", "recall": None}
+    
+    return embeddings.measure_ann_recall(nprobe=nprobe, k=k, samples=samples)
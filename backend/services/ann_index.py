@@ -0,0 +1,132 @@
+"""
+Indice ANN (Approximate Nearest Neighbour) IVF-flat in puro NumPy.
+I vettori vengono partizionati in `nlist` cluster (k-means sferico):
+una query confronta solo i vettori dei `nprobe` cluster più vicini.
+nprobe è la manopola recall/latenza: nprobe = nlist equivale a brute force.
+"""
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .embedding_index import normalize
+
+
+_CHUNK_ROWS = 4096
+
+
+def _nearest_centroid(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Assegna ogni vettore (normalizzato) al centroide più simile, a blocchi."""
+    result = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], _CHUNK_ROWS):
+        chunk = vectors[start:start + _CHUNK_ROWS]
+        result[start:start + _CHUNK_ROWS] = (chunk @ centroids.T).argmax(axis=1)
+    return result
+
+
+class IVFIndex:
+    """
+    Centroidi IVF: la lista di appartenenza di ogni vettore è mantenuta
+    dall'EmbeddingIndex, allineata alle righe della matrice.
+    """
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = normalize(centroids)
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        nlist: int,
+        iterations: int = 15,
+        max_training_points: int = 100_000,
+        seed: int = 0
+    ) -> "IVFIndex":
+        """
+        K-means sferico sui vettori normalizzati.
+        Per inventari grandi si allena su un campione casuale.
+        """
+        rng = np.random.default_rng(seed)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[0] > max_training_points:
+            sample_rows = rng.choice(vectors.shape[0], max_training_points, replace=False)
+            vectors = vectors[sample_rows]
+
+        nlist = max(1, min(nlist, vectors.shape[0]))
+        centroids = vectors[rng.choice(vectors.shape[0], nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = _nearest_centroid(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=nlist)
+
+            # Cluster vuoti: riparti da un punto casuale
+            empty = np.flatnonzero(counts == 0)
+            if empty.size:
+                sums[empty] = vectors[rng.choice(vectors.shape[0], empty.size)]
+
+            centroids = normalize(sums)
+
+        return cls(centroids)
+
+    def assign(self, vectors: np.ndarray) -> np.ndarray:
+        """Lista IVF di appartenenza per vettori già normalizzati."""
+        vectors = np.atleast_2d(vectors)
+        return _nearest_centroid(vectors, self.centroids)
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Le `nprobe` liste più vicine alla query (normalizzata)."""
+        nprobe = max(1, min(nprobe, self.nlist))
+        scores = self.centroids @ query
+        if nprobe == self.nlist:
+            return np.arange(self.nlist, dtype=np.int32)
+        return np.argpartition(-scores, nprobe - 1)[:nprobe].astype(np.int32)
+
+    def save(self, path: Path, ids: np.ndarray, lists: np.ndarray, model: str = ""):
+        """
+        Salva centroidi e assegnazioni su disco (scrittura atomica),
+        così al riavvio non serve ripetere il k-means.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                ids=np.asarray(ids, dtype=np.int64),
+                lists=np.asarray(lists, dtype=np.int32),
+                model=np.array(model)
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        model: str = ""
+    ) -> Optional[Tuple["IVFIndex", np.ndarray, np.ndarray]]:
+        """
+        Carica un indice salvato.
+        Ritorna (indice, ids, liste) o None se assente, corrotto o
+        generato con un modello diverso.
+        """
+        path = Path(path)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data["model"]) != model:
+                    return None
+                return cls(data["centroids"]), data["ids"], data["lists"]
+        except Exception:
+            return None
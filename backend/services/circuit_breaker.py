@@ -0,0 +1,103 @@
+"""
+Circuit breaker per servizi esterni (API embeddings).
+Dopo `failure_threshold` errori consecutivi il circuito si apre e le
+chiamate vengono saltate per `cooldown_seconds`; poi una sola chiamata
+di prova (half-open) decide se richiuderlo o riaprirlo.
+"""
+import threading
+import time
+from typing import Optional
+
+
+class CircuitOpenError(RuntimeError):
+    """Chiamata saltata perché il circuito è aperto."""
+
+
+class CircuitBreaker:
+    """Stati: closed (normale), open (cool-down), half_open (prova)."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, cooldown_seconds: float):
+        self._lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self.total_failures = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def is_open(self) -> bool:
+        """True se le chiamate verrebbero saltate adesso."""
+        with self._lock:
+            state = self._current_state()
+            return state == self.OPEN or (
+                state == self.HALF_OPEN and self._trial_in_flight
+            )
+
+    def allow(self) -> bool:
+        """Chiede il permesso per una chiamata (consuma la prova half-open)."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.total_failures += 1
+            self._failures += 1
+            self._trial_in_flight = False
+            if (
+                self._state == self.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            retry_in = None
+            if state == self.OPEN:
+                retry_in = max(
+                    0.0,
+                    self.cooldown_seconds - (time.monotonic() - self._opened_at)
+                )
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "total_failures": self.total_failures,
+                "short_circuited": self.short_circuited,
+                "retry_in_seconds": retry_in
+            }
+
+    def _current_state(self) -> str:
+        """Stato effettivo: OPEN diventa HALF_OPEN a cool-down scaduto (lock già preso)."""
+        if (
+            self._state == self.OPEN
+            and time.monotonic() - self._opened_at >= self.cooldown_seconds
+        ):
+            return self.HALF_OPEN
+        return self._state
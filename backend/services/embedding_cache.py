@@ -0,0 +1,195 @@
+"""
+Cache a due livelli per gli embeddings:
+1. LRU in memoria, limitata per numero di voci e byte
+2. Tabella SQLite `embedding_cache`, condivisa tra worker e persistente
+Chiave: hash di testo normalizzato + nome modello.
+La tabella è letta/scritta con connessioni proprie (BackgroundSessionLocal):
+le chiamate arrivano anche da thread paralleli alla richiesta.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import bindparam, text
+
+from ..config import settings
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(value: str) -> str:
+    """Normalizza un testo per la chiave di cache (case e spazi)."""
+    return _WHITESPACE.sub(" ", value.strip().lower())
+
+
+def cache_key(value: str, model: str) -> str:
+    """Hash SHA-256 di modello + testo normalizzato."""
+    payload = f"{model}\n{normalize_text(value)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    LRU in memoria davanti alla tabella SQLite.
+    I vettori sono salvati come float32, indipendentemente dal
+    formato di storage degli items.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, value: str, model: str) -> Optional[np.ndarray]:
+        """Cerca prima in memoria, poi su SQLite (promuovendo in memoria)."""
+        return self.get_many([value], model)[0]
+
+    def get_many(self, values: List[str], model: str) -> List[Optional[np.ndarray]]:
+        """
+        Lookup di più testi: memoria, poi una sola query SQLite
+        per tutte le chiavi mancanti.
+        """
+        keys = [cache_key(value, model) for value in values]
+        found: Dict[str, np.ndarray] = {}
+
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        disk = self._disk_get_many(missing) if missing else {}
+
+        with self._lock:
+            for key, vector in disk.items():
+                self._memory_put(key, vector)
+            for key in keys:
+                if key in disk:
+                    self.disk_hits += 1
+                elif key in found:
+                    self.memory_hits += 1
+                else:
+                    self.misses += 1
+
+        found.update(disk)
+        return [found.get(key) for key in keys]
+
+    def put(self, value: str, model: str, vector) -> np.ndarray:
+        """Salva un embedding in entrambi i livelli."""
+        return self.put_many([value], model, [vector])[0]
+
+    def put_many(self, values: List[str], model: str, vectors: List) -> List[np.ndarray]:
+        """Salva più embeddings in una sola transazione SQLite."""
+        keys = [cache_key(value, model) for value in values]
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._memory_put(key, vector)
+        self._disk_put_many(keys, model, vectors)
+        return vectors
+
+    def clear_memory(self):
+        """Svuota il livello in memoria (SQLite resta intatto)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Contatori hit/miss/eviction e occupazione del livello in memoria."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (
+                    (self.memory_hits + self.disk_hits) / lookups
+                    if lookups else None
+                )
+            }
+
+    def _memory_put(self, key: str, vector: np.ndarray):
+        """Inserisce in LRU ed effettua eviction oltre i limiti (lock già preso)."""
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+
+        self._entries[key] = vector
+        self._bytes += vector.nbytes
+
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or self._bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _disk_get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        from ..database import BackgroundSessionLocal
+
+        db = BackgroundSessionLocal()
+        try:
+            rows = db.execute(
+                text(
+                    "SELECT key, embedding FROM embedding_cache WHERE key IN :keys"
+                ).bindparams(bindparam("keys", expanding=True)),
+                {"keys": keys}
+            ).fetchall()
+        except Exception:
+            return {}
+        finally:
+            db.close()
+
+        return {
+            key: np.frombuffer(blob, dtype=np.float32)
+            for key, blob in rows if blob
+        }
+
+    def _disk_put_many(self, keys: List[str], model: str, vectors: List[np.ndarray]):
+        from ..database import BackgroundSessionLocal
+
+        db = BackgroundSessionLocal()
+        try:
+            db.execute(
+                text(
+                    "INSERT OR REPLACE INTO embedding_cache "
+                    "(key, model, embedding, created_at) "
+                    "VALUES (:key, :model, :embedding, CURRENT_TIMESTAMP)"
+                ),
+                [
+                    {"key": key, "model": model, "embedding": vector.tobytes()}
+                    for key, vector in zip(keys, vectors)
+                ]
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Errore scrittura cache embeddings: {e}")
+        finally:
+            db.close()
+
+
+# Istanza condivisa dal processo
+embedding_cache = EmbeddingCache(
+    max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+    max_bytes=settings.EMBEDDING_CACHE_MAX_BYTES
+)
@@ -0,0 +1,480 @@
+"""
+Indice in memoria degli embeddings per ricerca semantica vettorizzata.
+Mantiene una matrice contigua di vettori pre-normalizzati e un array di ID:
+una query è un singolo prodotto matrice-vettore (BLAS) + argpartition.
+Opzionalmente un indice IVF (ann_index.py) restringe il prodotto
+ai soli cluster più vicini alla query.
+Con quantizzazione int8 la matrice occupa 1 byte per componente
+(+ una scala float32 per riga) e i punteggi sono calcolati a blocchi.
+Le ricerche condividono un lock in lettura e girano in parallelo (NumPy
+rilascia il GIL durante il prodotto); le scritture sono esclusive.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from ..config import settings
+
+
+_SCORE_CHUNK_ROWS = 8192
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Normalizza (L2) un vettore o le righe di una matrice, in float32."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizzazione scalare simmetrica per riga: v ~= codes * scale,
+    con scale = max|v| / 127. Ritorna (codes int8, scale float32).
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class ReadWriteLock:
+    """
+    Lock lettori/scrittori: più lettori insieme, scrittori esclusivi.
+    Uno scrittore in attesa blocca i nuovi lettori (niente starvation
+    delle scritture). Non rientrante: non annidare le acquisizioni.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class EmbeddingIndex:
+    """
+    Indice process-resident degli embeddings degli items attivi.
+    Caricato all'avvio (lifespan) e aggiornato incrementalmente
+    su create/update/delete. Ogni worker uvicorn ha la propria copia.
+    """
+
+    def __init__(self, initial_capacity: int = 1024, quantization: str = "none"):
+        self._lock = ReadWriteLock()
+        self._initial_capacity = initial_capacity
+        self.quantization = quantization
+        self._matrix: Optional[np.ndarray] = None  # (capacity, dim) float32 o int8
+        self._scales: Optional[np.ndarray] = None  # (capacity,) solo int8
+        self._ids = np.empty(0, dtype=np.int64)    # (capacity,)
+        self._rows: Dict[int, int] = {}            # item_id -> riga
+        self._size = 0
+        self._ivf = None                           # IVFIndex opzionale
+        self._lists = np.empty(0, dtype=np.int32)  # lista IVF per riga
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._rows
+
+    @property
+    def dim(self) -> Optional[int]:
+        """Dimensione dei vettori indicizzati (None se vuoto)."""
+        return None if self._matrix is None else self._matrix.shape[1]
+
+    @property
+    def ivf(self):
+        """Indice IVF attivo (None = solo brute force)."""
+        return self._ivf
+
+    @property
+    def quantized(self) -> bool:
+        return self.quantization == "int8"
+
+    def stats(self) -> dict:
+        """Occupazione in memoria dei vettori indicizzati."""
+        with self._lock.read():
+            vector_bytes = 0
+            if self._matrix is not None:
+                vector_bytes = self._matrix[:self._size].nbytes
+                if self._scales is not None:
+                    vector_bytes += self._scales[:self._size].nbytes
+            return {
+                "items": self._size,
+                "dim": self.dim,
+                "quantization": self.quantization,
+                "vector_bytes": vector_bytes,
+                "ivf_nlist": self._ivf.nlist if self._ivf is not None else None
+            }
+
+    def load(self, rows: Iterable[Tuple[int, np.ndarray]]):
+        """
+        Sostituisce il contenuto dell'indice.
+        rows: [(item_id, vettore), ...]; vettori di dimensione diversa
+        dal primo vengono scartati.
+        """
+        ids, vectors, scales = [], [], []
+        for item_id, vector in rows:
+            if vector is None or len(vector) == 0:
+                continue
+            if vectors and len(vector) != len(vectors[0]):
+                continue
+            # Codifica riga per riga: in modalità int8 non si accumula
+            # mai l'intera matrice in float32
+            codes, scale = self._encode(vector)
+            ids.append(item_id)
+            vectors.append(codes)
+            scales.append(scale)
+
+        with self._lock.write():
+            self._rows = {item_id: row for row, item_id in enumerate(ids)}
+            self._size = len(ids)
+            self._ivf = None
+            self._lists = np.zeros(max(self._initial_capacity, self._size), dtype=np.int32)
+            if not ids:
+                self._matrix = None
+                self._scales = None
+                self._ids = np.empty(0, dtype=np.int64)
+                return
+
+            capacity = max(self._initial_capacity, self._size)
+            self._allocate(capacity, len(vectors[0]))
+            self._matrix[:self._size] = np.vstack(vectors)
+            if self._scales is not None:
+                self._scales[:self._size] = scales
+            self._ids[:self._size] = ids
+
+    def upsert(self, item_id: int, vector) -> bool:
+        """Aggiunge o sostituisce il vettore di un item."""
+        if vector is None or len(vector) == 0:
+            self.remove(item_id)
+            return False
+
+        vector = normalize(vector)
+        codes, scale = self._encode(vector)
+        with self._lock.write():
+            if self._matrix is None:
+                self._allocate(self._initial_capacity, vector.shape[0])
+            elif vector.shape[0] != self._matrix.shape[1]:
+                return False
+
+            row = self._rows.get(item_id)
+            if row is None:
+                if self._size == self._matrix.shape[0]:
+                    self._grow()
+                row = self._size
+                self._size += 1
+                self._rows[item_id] = row
+                self._ids[row] = item_id
+
+            self._matrix[row] = codes
+            if self._scales is not None:
+                self._scales[row] = scale
+            if self._ivf is not None:
+                self._lists[row] = self._ivf.assign(vector)[0]
+            return True
+
+    def remove(self, item_id: int) -> bool:
+        """Rimuove un item spostando l'ultima riga al suo posto (O(dim))."""
+        with self._lock.write():
+            row = self._rows.pop(item_id, None)
+            if row is None:
+                return False
+
+            last = self._size - 1
+            if row != last:
+                moved_id = int(self._ids[last])
+                self._matrix[row] = self._matrix[last]
+                if self._scales is not None:
+                    self._scales[row] = self._scales[last]
+                self._ids[row] = moved_id
+                self._lists[row] = self._lists[last]
+                self._rows[moved_id] = row
+            self._size = last
+            return True
+
+    def search(
+        self,
+        query_vector,
+        threshold: float = 0.3,
+        limit: int = 20,
+        nprobe: Optional[int] = None,
+        item_ids: Optional[Iterable[int]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Top-k per similarità coseno.
+        Con IVF attivo e nprobe < nlist valuta solo i cluster più vicini.
+        item_ids: restringe la ricerca a questi items (es. sottoalbero di
+        una location); valuta solo le loro righe, in modo esatto.
+        Ritorna lista di (item_id, similarity) ordinata per rilevanza.
+        """
+        query = normalize(query_vector)
+        with self._lock.read():
+            if self._size == 0 or query.shape[0] != self._matrix.shape[1]:
+                return []
+
+            if item_ids is not None:
+                rows = np.fromiter(
+                    (self._rows[i] for i in item_ids if i in self._rows),
+                    dtype=np.int64
+                )
+                scores = self._score(rows, query)
+                ids = self._ids[rows]
+            elif self._ivf is not None and nprobe and nprobe < self._ivf.nlist:
+                probes = self._ivf.probe(query, nprobe)
+                rows = np.flatnonzero(np.isin(self._lists[:self._size], probes))
+                scores = self._score(rows, query)
+                ids = self._ids[rows]
+            else:
+                scores = self._score(slice(0, self._size), query)
+                ids = self._ids[:self._size].copy()
+
+        return _top_k(scores, ids, threshold, limit)
+
+    def search_many(
+        self,
+        query_vectors,
+        threshold: float = 0.3,
+        limit: int = 20,
+        nprobe: Optional[int] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Top-k per più query con un solo prodotto matrice-matrice
+        (n x dim) @ (dim x m). Con IVF attivo valuta l'unione dei cluster
+        sondati e scarta per ogni query le righe fuori dai suoi cluster.
+        Ritorna una lista di risultati per query, nello stesso ordine.
+        """
+        queries = normalize(np.atleast_2d(query_vectors))
+        with self._lock.read():
+            if self._size == 0 or queries.shape[1] != self._matrix.shape[1]:
+                return [[] for _ in range(queries.shape[0])]
+
+            if self._ivf is not None and nprobe and nprobe < self._ivf.nlist:
+                probes = [self._ivf.probe(query, nprobe) for query in queries]
+                lists = self._lists[:self._size]
+                rows = np.flatnonzero(np.isin(lists, np.unique(np.concatenate(probes))))
+                scores = self._score(rows, queries.T)
+                row_lists = lists[rows]
+                for column, probe in enumerate(probes):
+                    scores[~np.isin(row_lists, probe), column] = -np.inf
+                ids = self._ids[rows]
+            else:
+                scores = self._score(slice(0, self._size), queries.T)
+                ids = self._ids[:self._size].copy()
+
+        return [
+            _top_k(scores[:, column], ids, threshold, limit)
+            for column in range(scores.shape[1])
+        ]
+
+    # ============== IVF ==============
+
+    def attach_ivf(
+        self,
+        ivf,
+        known_ids: Optional[np.ndarray] = None,
+        known_lists: Optional[np.ndarray] = None
+    ) -> bool:
+        """
+        Attiva un indice IVF. Le assegnazioni note (es. caricate da disco)
+        vengono riusate; gli items mancanti vengono assegnati ora.
+        """
+        with self._lock.write():
+            if self._matrix is None or ivf.dim != self._matrix.shape[1]:
+                return False
+
+            lists = np.full(self._size, -1, dtype=np.int32)
+            if known_ids is not None and known_lists is not None:
+                for item_id, list_no in zip(known_ids.tolist(), known_lists.tolist()):
+                    row = self._rows.get(item_id)
+                    if row is not None and 0 <= list_no < ivf.nlist:
+                        lists[row] = list_no
+
+            missing = np.flatnonzero(lists < 0)
+            if missing.size:
+                lists[missing] = ivf.assign(self._vectors(missing))
+
+            self._lists[:self._size] = lists
+            self._ivf = ivf
+            return True
+
+    def detach_ivf(self):
+        """Torna alla ricerca brute force."""
+        with self._lock.write():
+            self._ivf = None
+
+    def train_ivf(self, nlist: int):
+        """Allena un IVF sui vettori correnti e lo attiva."""
+        from .ann_index import IVFIndex
+
+        with self._lock.read():
+            if self._size == 0:
+                return None
+            vectors = self._vectors(slice(0, self._size))
+
+        ivf = IVFIndex.train(vectors, nlist)
+        self.attach_ivf(ivf)
+        return ivf
+
+    def ivf_state(self) -> Optional[Tuple[object, np.ndarray, np.ndarray]]:
+        """Snapshot (ivf, ids, liste) per la persistenza su disco."""
+        with self._lock.read():
+            if self._ivf is None:
+                return None
+            return (
+                self._ivf,
+                self._ids[:self._size].copy(),
+                self._lists[:self._size].copy()
+            )
+
+    def measure_recall(
+        self,
+        nprobe: int,
+        k: int = 10,
+        samples: int = 100,
+        seed: int = 0
+    ) -> dict:
+        """
+        Confronta la ricerca IVF con il brute force su un campione di
+        items usati come query. Utile per tarare nprobe.
+        """
+        with self._lock.read():
+            size = self._size
+            if size == 0:
+                return {"samples": 0, "recall": None}
+            rng = np.random.default_rng(seed)
+            rows = rng.choice(size, min(samples, size), replace=False)
+            queries = self._vectors(rows)
+
+        hits = 0
+        ann_time = exact_time = 0.0
+        for query in queries:
+            start = time.perf_counter()
+            exact = self.search(query, threshold=-1.0, limit=k)
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approx = self.search(query, threshold=-1.0, limit=k, nprobe=nprobe)
+            ann_time += time.perf_counter() - start
+
+            hits += len({i for i, _ in exact} & {i for i, _ in approx})
+
+        expected = len(queries) * min(k, size)
+        return {
+            "samples": len(queries),
+            "k": k,
+            "nprobe": nprobe,
+            "nlist": self._ivf.nlist if self._ivf is not None else None,
+            "recall": hits / expected,
+            "ann_ms": 1000 * ann_time / len(queries),
+            "exact_ms": 1000 * exact_time / len(queries)
+        }
+
+    # ============== Storage ==============
+
+    def _encode(self, vector) -> Tuple[np.ndarray, Optional[float]]:
+        """Vettore normalizzato nel formato di storage: (riga, scala o None)."""
+        vector = normalize(vector)
+        if not self.quantized:
+            return vector, None
+        codes, scales = quantize_int8(vector)
+        return codes[0], float(scales[0])
+
+    def _allocate(self, capacity: int, dim: int):
+        """Alloca matrice, scale, ids e liste IVF vuoti (lock già preso)."""
+        dtype = np.int8 if self.quantized else np.float32
+        self._matrix = np.zeros((capacity, dim), dtype=dtype)
+        self._scales = np.zeros(capacity, dtype=np.float32) if self.quantized else None
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._lists = np.zeros(capacity, dtype=np.int32)
+
+    def _vectors(self, rows) -> np.ndarray:
+        """Copia float32 (dequantizzata) delle righe indicate."""
+        if self._scales is None:
+            return self._matrix[rows].copy()
+        return self._matrix[rows].astype(np.float32) * self._scales[rows, None]
+
+    def _score(self, rows, query: np.ndarray) -> np.ndarray:
+        """
+        Similarità delle righe con la query normalizzata (dim,) o con
+        più query (dim, m). In int8 dequantizza a blocchi di
+        _SCORE_CHUNK_ROWS righe, così la memoria temporanea resta
+        limitata anche con indici grandi.
+        """
+        if self._scales is None:
+            return self._matrix[rows] @ query
+
+        codes = self._matrix[rows]
+        scales = self._scales[rows]
+        scores = np.empty((codes.shape[0],) + query.shape[1:], dtype=np.float32)
+        for start in range(0, codes.shape[0], _SCORE_CHUNK_ROWS):
+            end = start + _SCORE_CHUNK_ROWS
+            scores[start:end] = codes[start:end].astype(np.float32) @ query
+        return scores * (scales if scores.ndim == 1 else scales[:, None])
+
+    def _grow(self):
+        """Raddoppia la capacità della matrice (ammortizzato O(1) per insert)."""
+        matrix, scales = self._matrix, self._scales
+        ids, lists = self._ids, self._lists
+        self._allocate(matrix.shape[0] * 2, matrix.shape[1])
+        self._matrix[:self._size] = matrix[:self._size]
+        if scales is not None:
+            self._scales[:self._size] = scales[:self._size]
+        self._ids[:self._size] = ids[:self._size]
+        self._lists[:self._size] = lists[:self._size]
+
+
+def _top_k(
+    scores: np.ndarray,
+    ids: np.ndarray,
+    threshold: float,
+    limit: int
+) -> List[Tuple[int, float]]:
+    """Seleziona i migliori `limit` punteggi sopra soglia con argpartition."""
+    candidates = np.flatnonzero(scores >= threshold)
+    if candidates.size == 0:
+        return []
+
+    if candidates.size > limit:
+        top = np.argpartition(-scores[candidates], limit - 1)[:limit]
+        candidates = candidates[top]
+
+    candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [(int(ids[i]), float(scores[i])) for i in candidates]
+
+
+# Istanza condivisa dal processo
+embedding_index = EmbeddingIndex(quantization=settings.EMBEDDING_QUANTIZATION)
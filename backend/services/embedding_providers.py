@@ -0,0 +1,205 @@
+"""
+Provider di embeddings intercambiabili, selezionati da settings.EMBEDDING_PROVIDER:
+- openai: text-embedding-3-small via API (richiede OPENAI_API_KEY)
+- local:  n-grammi di caratteri con hashing, solo CPU/NumPy, funziona offline
+- fake:   vettori deterministici derivati dall'hash del testo (per i test)
+"""
+import hashlib
+import math
+import re
+import threading
+import unicodedata
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+from ..config import settings
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class EmbeddingProvider:
+    """
+    Interfaccia comune dei provider.
+    `model` identifica lo spazio vettoriale: entra nelle chiavi di cache
+    e nell'hash di contenuto, quindi cambiarlo invalida gli embeddings.
+    """
+    name: str = ""
+    model: str = ""
+    cacheable: bool = False  # True se ogni chiamata ha un costo (rete/API)
+
+    def is_available(self) -> bool:
+        return True
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Un vettore per ogni testo; solleva eccezione in caso di errore."""
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        """Stato per /api/health."""
+        return {
+            "provider": self.name,
+            "model": self.model,
+            "available": self.is_available()
+        }
+
+
+class OpenAIProvider(EmbeddingProvider):
+    """
+    Embeddings OpenAI (una chiamata API per lista di testi).
+    Un solo client per processo (connessioni HTTP keep-alive riusate),
+    timeout stretti e circuit breaker: con l'API lenta o giù la ricerca
+    passa subito a FTS5 invece di attendere i timeout ad ogni richiesta.
+    """
+    name = "openai"
+    model = "text-embedding-3-small"  # Modello economico e veloce
+    cacheable = True
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.breaker = CircuitBreaker(
+            failure_threshold=settings.OPENAI_BREAKER_FAILURES,
+            cooldown_seconds=settings.OPENAI_BREAKER_COOLDOWN_SECONDS
+        )
+
+    def get_client(self):
+        """Ritorna il client OpenAI condiviso (creato al primo uso) se configurato."""
+        if not settings.OPENAI_API_KEY:
+            return None
+
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    try:
+                        import httpx
+                        from openai import OpenAI
+                        self._client = OpenAI(
+                            api_key=settings.OPENAI_API_KEY,
+                            timeout=httpx.Timeout(
+                                settings.OPENAI_TIMEOUT_SECONDS,
+                                connect=settings.OPENAI_CONNECT_TIMEOUT_SECONDS
+                            ),
+                            max_retries=0  # I retry li gestisce il worker
+                        )
+                    except Exception:
+                        return None
+        return self._client
+
+    def is_available(self) -> bool:
+        """Nessuna chiamata di rete: chiave presente, client creato, circuito non aperto."""
+        return (
+            bool(settings.OPENAI_API_KEY)
+            and not self.breaker.is_open()
+            and self.get_client() is not None
+        )
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        client = self.get_client()
+        if not client:
+            raise RuntimeError("OpenAI non configurato")
+        if not self.breaker.allow():
+            raise CircuitOpenError("OpenAI temporaneamente disabilitato (circuit breaker)")
+
+        try:
+            response = client.embeddings.create(model=self.model, input=texts)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+    def status(self) -> dict:
+        status = super().status()
+        status["circuit"] = self.breaker.stats()
+        return status
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def _fold(text: str) -> str:
+    """Minuscolo e senza accenti ("perché" -> "perche")."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class LocalHashingProvider(EmbeddingProvider):
+    """
+    Embeddings locali: parole e n-grammi di caratteri (3-4) proiettati
+    con feature hashing su `dim` componenti, peso TF sublineare.
+    Nessuna rete né modello da scaricare; tollera typo e flessioni
+    ("cacciavite"/"cacciaviti") grazie agli n-grammi condivisi.
+    """
+    name = "local"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.model = f"local-ngram-{dim}"
+
+    def _features(self, text: str) -> dict:
+        counts: dict = {}
+        for word in _TOKEN.findall(_fold(text)):
+            counts[word] = counts.get(word, 0) + 2  # parola intera pesa di più
+            padded = f" {word} "
+            for n in (3, 4):
+                for i in range(len(padded) - n + 1):
+                    gram = padded[i:i + n]
+                    counts[gram] = counts.get(gram, 0) + 1
+        return counts
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in self._features(text).items():
+            h = zlib.crc32(feature.encode("utf-8"))
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            vector[h % self.dim] += sign * (1.0 + math.log(count))
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_one(t) for t in texts]
+
+
+class FakeProvider(EmbeddingProvider):
+    """
+    Vettori pseudo-casuali deterministici (seed = hash del testo
+    normalizzato). Stesso testo -> stesso vettore; utile nei test.
+    """
+    name = "fake"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.model = f"fake-{dim}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for text in texts:
+            digest = hashlib.sha256(_fold(text.strip()).encode("utf-8")).digest()
+            rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+            vectors.append(rng.standard_normal(self.dim).astype(np.float32))
+        return vectors
+
+
+_provider: Optional[EmbeddingProvider] = None
+
+
+def get_provider() -> EmbeddingProvider:
+    """Provider configurato (istanza unica per processo)."""
+    global _provider
+    if _provider is None or _provider.name != settings.EMBEDDING_PROVIDER:
+        _provider = create_provider(settings.EMBEDDING_PROVIDER)
+    return _provider
+
+
+def create_provider(name: str) -> EmbeddingProvider:
+    """Istanzia un provider per nome."""
+    if name == "openai":
+        return OpenAIProvider()
+    if name == "local":
+        return LocalHashingProvider(settings.LOCAL_EMBEDDING_DIM)
+    if name == "fake":
+        return FakeProvider(settings.LOCAL_EMBEDDING_DIM)
+    raise ValueError(f"Provider embeddings sconosciuto: {name}")
@@ -0,0 +1,299 @@
+"""
+Worker in background per la generazione degli embeddings.
+Gli items vengono creati subito con embedding_status = PENDING;
+questo task asyncio (avviato nel lifespan) li raccoglie a batch,
+genera gli embeddings fuori dal request path e li salva.
+In caso di errore riprova con backoff esponenziale; gli items che
+falliscono passano in coda agli altri (embedding_attempts) e dopo
+EMBEDDING_MAX_ATTEMPTS tentativi diventano FAILED, così un item che il
+provider rifiuta sempre non blocca quelli successivi.
+Il worker usa connessioni proprie (BackgroundSessionLocal): non
+condivide la transazione delle richieste in corso.
+All'avvio (lifespan) un reconciler marca PENDING gli embeddings non più validi
+(descrizione o modello cambiati): niente rebuild completi. Anche i FAILED
+tornano PENDING per un nuovo giro di tentativi.
+"""
+import asyncio
+from typing import Optional
+
+from sqlalchemy import bindparam, text
+
+from ..config import settings
+from .search_cache import bump_data_generation
+
+
+def process_pending_batch(batch_size: Optional[int] = None) -> int:
+    """
+    Genera gli embeddings per un batch di items PENDING.
+    Ritorna il numero di items aggiornati; solleva RuntimeError se
+    il provider non ha restituito nessun vettore (per il backoff).
+    """
+    from ..database import BackgroundSessionLocal, Item, EmbeddingStatus
+    from . import embeddings
+
+    if not embeddings.is_semantic_search_available():
+        return 0
+
+    db = BackgroundSessionLocal()
+    try:
+        rows = db.query(Item.id, Item.description).filter(
+            Item.embedding_status == EmbeddingStatus.PENDING,
+            Item.deleted_at.is_(None)
+        ).order_by(
+            Item.embedding_attempts, Item.id
+        ).limit(batch_size or settings.EMBEDDING_BATCH_SIZE).all()
+
+        if not rows:
+            return 0
+
+        descriptions = [row.description for row in rows]
+        vectors = embeddings.generate_embeddings(descriptions)
+        if (
+            len(rows) > 1
+            and all(vector is None for vector in vectors)
+            and embeddings.is_semantic_search_available()
+        ):
+            # Un solo testo rifiutato fa fallire l'intera chiamata:
+            # un testo per chiamata isola quelli da scartare
+            vectors = [embeddings.generate_embedding(d) for d in descriptions]
+        model = embeddings.current_model()
+        updates = [
+            {
+                "id": row.id,
+                "description": row.description,
+                "embedding": embeddings.embedding_to_blob(vector),
+                "embedding_hash": embeddings.content_hash(row.description),
+                "embedding_model": model
+            }
+            for row, vector in zip(rows, vectors)
+            if vector is not None
+        ]
+        # Con il provider non disponibile (es. circuito aperto) l'errore
+        # non dipende dagli items: nessun tentativo contato, solo backoff
+        failed = [row.id for row, vector in zip(rows, vectors) if vector is None]
+        if failed and embeddings.is_semantic_search_available():
+            _record_failures(db, failed)
+        if not updates:
+            raise RuntimeError("Nessun embedding generato")
+
+        # La descrizione potrebbe essere cambiata nel frattempo:
+        # in quel caso la riga resta PENDING per il prossimo giro
+        db.execute(
+            text(
+                "UPDATE items SET embedding = :embedding, "
+                "embedding_hash = :embedding_hash, "
+                "embedding_model = :embedding_model, embedding_status = 'READY', "
+                "embedding_attempts = 0 "
+                "WHERE id = :id AND description = :description "
+                "AND embedding_status = 'PENDING' AND deleted_at IS NULL"
+            ),
+            updates
+        )
+        db.commit()
+
+        # Sincronizza indice in memoria con le righe effettivamente aggiornate
+        ready = db.execute(
+            text(
+                "SELECT id, embedding FROM items "
+                "WHERE id IN :ids AND embedding_status = 'READY' "
+                "AND deleted_at IS NULL"
+            ).bindparams(bindparam("ids", expanding=True)),
+            {"ids": [u["id"] for u in updates]}
+        ).fetchall()
+        for item_id, blob in ready:
+            embeddings.index_item(item_id, blob)
+        if ready:
+            bump_data_generation()
+
+        return len(ready)
+    finally:
+        db.close()
+
+
+def _record_failures(db, item_ids):
+    """
+    Conta un tentativo fallito per ogni item (in coda ai prossimi batch);
+    al raggiungimento di EMBEDDING_MAX_ATTEMPTS l'item diventa FAILED.
+    Esegue il commit.
+    """
+    rows = db.execute(
+        text(
+            "UPDATE items SET embedding_attempts = embedding_attempts + 1, "
+            "embedding_status = CASE WHEN embedding_attempts + 1 >= :max_attempts "
+            "THEN 'FAILED' ELSE embedding_status END "
+            "WHERE id IN :ids AND embedding_status = 'PENDING' "
+            "RETURNING id, embedding_status"
+        ).bindparams(bindparam("ids", expanding=True)),
+        {"ids": item_ids, "max_attempts": settings.EMBEDDING_MAX_ATTEMPTS}
+    ).fetchall()
+    db.commit()
+
+    given_up = [row.id for row in rows if row.embedding_status == "FAILED"]
+    if given_up:
+        print(f"Embeddings non generati dopo {settings.EMBEDDING_MAX_ATTEMPTS} tentativi: {given_up}")
+
+
+def reconcile_embeddings(batch_size: int = 1000) -> dict:
+    """
+    Confronta ogni embedding READY con la descrizione e il modello
+    correnti (hash di contenuto) e marca PENDING quelli non più validi,
+    togliendoli dall'indice in memoria; il worker li rigenera a batch.
+    Gli items con descrizione ma senza stato diventano PENDING, come i
+    FAILED (nuovo giro di tentativi dopo il riavvio).
+    Ritorna i conteggi per tipo di correzione.
+    """
+    from ..database import BackgroundSessionLocal, Item, EmbeddingStatus
+    from . import embeddings
+
+    model = embeddings.current_model()
+    stale, adopted = [], []
+
+    db = BackgroundSessionLocal()
+    try:
+        rows = db.query(
+            Item.id, Item.description, Item.embedding_hash, Item.embedding_model
+        ).filter(
+            Item.embedding_status == EmbeddingStatus.READY,
+            Item.deleted_at.is_(None)
+        ).yield_per(batch_size)
+
+        for row in rows:
+            if row.embedding_hash == embeddings.content_hash(row.description or ""):
+                # L'hash include il modello: embedding valido, colonna da allineare
+                if row.embedding_model != model:
+                    adopted.append(row.id)
+            else:
+                stale.append(row.id)
+
+        for start in range(0, len(stale), batch_size):
+            db.execute(
+                text(
+                    "UPDATE items SET embedding = NULL, embedding_hash = NULL, "
+                    "embedding_model = NULL, embedding_attempts = 0, embedding_status = CASE "
+                    "WHEN trim(coalesce(description, '')) != '' THEN 'PENDING' END "
+                    "WHERE id IN :ids"
+                ).bindparams(bindparam("ids", expanding=True)),
+                {"ids": stale[start:start + batch_size]}
+            )
+        for start in range(0, len(adopted), batch_size):
+            db.execute(
+                text(
+                    "UPDATE items SET embedding_model = :model WHERE id IN :ids"
+                ).bindparams(bindparam("ids", expanding=True)),
+                {"model": model, "ids": adopted[start:start + batch_size]}
+            )
+
+        # Descrizione aggiunta senza stato / PENDING senza più descrizione
+        marked = db.execute(text(
+            "UPDATE items SET embedding_status = 'PENDING' "
+            "WHERE embedding_status IS NULL AND deleted_at IS NULL "
+            "AND trim(coalesce(description, '')) != ''"
+        )).rowcount
+        cleared = db.execute(text(
+            "UPDATE items SET embedding_status = NULL "
+            "WHERE embedding_status = 'PENDING' "
+            "AND trim(coalesce(description, '')) = ''"
+        )).rowcount
+        retried = db.execute(text(
+            "UPDATE items SET embedding_status = 'PENDING', embedding_attempts = 0 "
+            "WHERE embedding_status = 'FAILED' AND deleted_at IS NULL "
+            "AND trim(coalesce(description, '')) != ''"
+        )).rowcount
+        db.commit()
+    finally:
+        db.close()
+
+    for item_id in stale:
+        embeddings.unindex_item(item_id)
+    if stale or marked or cleared:
+        bump_data_generation()
+    if stale or marked or retried:
+        print(f"Embeddings da rigenerare: {len(stale) + marked + retried}")
+
+    return {
+        "stale": len(stale),
+        "adopted": len(adopted),
+        "marked": marked,
+        "cleared": cleared,
+        "retried": retried
+    }
+
+
+class EmbeddingWorker:
+    """Task asyncio che svuota la coda degli embeddings PENDING."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.failures = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Avvia il worker (chiamato nel lifespan)."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Ferma il worker allo shutdown."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def notify(self):
+        """
+        Sveglia il worker dopo l'inserimento di items PENDING.
+        Thread-safe: chiamabile dagli endpoint sync (threadpool).
+        """
+        if self._loop is None or self._wakeup is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # Event loop già chiuso
+
+    async def _run(self):
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await asyncio.to_thread(process_pending_batch, batch_size)
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                processed = 0
+                print(f"Errore worker embeddings (tentativo {self.failures}): {e}")
+
+            if processed >= batch_size:
+                continue  # Probabilmente ci sono altri items in coda
+
+            if self.failures:
+                delay = min(
+                    settings.EMBEDDING_RETRY_BASE_SECONDS * 2 ** (self.failures - 1),
+                    settings.EMBEDDING_RETRY_MAX_SECONDS
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    timeout=settings.EMBEDDING_WORKER_POLL_SECONDS
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+# Istanza condivisa dal processo
+embedding_worker = EmbeddingWorker()
@@ -1,67 +1,129 @@
 """
-Servizio per generazione e confronto embeddings usando OpenAI.
-Permette ricerca semantica intelligente.
+Servizio per generazione e confronto embeddings.
+Permette ricerca semantica intelligente; il provider (OpenAI, locale
+offline o fake per i test) è scelto da settings.EMBEDDING_PROVIDER.
 """
 import json
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Optional
 import numpy as np
 
 from ..config import settings
+from .embedding_cache import cache_key, embedding_cache, normalize_text
+from .embedding_index import embedding_index, normalize, quantize_int8
+from .embedding_providers import get_provider
 
 
-# Cache embeddings in memoria per ridurre chiamate API
-_embedding_cache: dict = {}
+def current_model() -> str:
+    """Identificativo del modello del provider attivo."""
+    return get_provider().model
 
 
-def get_openai_client():
-    """Ritorna client OpenAI se configurato."""
-    if not settings.OPENAI_API_KEY:
-        return None
-    
-    try:
-        from openai import OpenAI
-        return OpenAI(api_key=settings.OPENAI_API_KEY)
-    except Exception:
-        return None
+def generate_embedding(text: str) -> Optional[np.ndarray]:
+    """
+    Genera embedding vector (float32) per un testo.
+    Passa prima dalla cache (memoria + SQLite): un testo già visto,
+    anche prima di un riavvio, non richiama l'API.
+    Ritorna None se il provider non è disponibile.
+    """
+    return generate_embeddings([text])[0]
 
 
-def generate_embedding(text: str) -> Optional[List[float]]:
+def generate_embeddings(texts: List[str]) -> List[Optional[np.ndarray]]:
     """
-    Genera embedding vector per un testo usando OpenAI.
-    Ritorna None se OpenAI non disponibile.
+    Genera embeddings per più testi con una sola chiamata al provider
+    (l'endpoint embeddings OpenAI accetta una lista come input).
+    Solo i testi non in cache vengono inviati; testi vuoti -> None.
     """
-    if not text or not text.strip():
-        return None
+    results: List[Optional[np.ndarray]] = [None] * len(texts)
+    valid = [i for i, t in enumerate(texts) if t and t.strip()]
+    if not valid:
+        return results
     
-    # Check cache
-    cache_key = text.strip().lower()
-    if cache_key in _embedding_cache:
-        return _embedding_cache[cache_key]
+    provider = get_provider()
+    if not provider.is_available():
+        return results
     
-    client = get_openai_client()
-    if not client:
-        return None
+    # Check cache (solo per provider con costo per chiamata)
+    missing: dict = {}  # testo normalizzato -> indici
+    if provider.cacheable:
+        cached = embedding_cache.get_many([texts[i] for i in valid], provider.model)
+    else:
+        cached = [None] * len(valid)
+    for i, vector in zip(valid, cached):
+        if vector is not None:
+            results[i] = vector
+        else:
+            missing.setdefault(normalize_text(texts[i]), []).append(i)
+    
+    if not missing:
+        return results
     
     try:
-        response = client.embeddings.create(
-            model="text-embedding-3-small",  # Modello economico e veloce
-            input=text.strip()
-        )
-        embedding = response.data[0].embedding
+        inputs = [texts[indices[0]].strip() for indices in missing.values()]
+        vectors = provider.embed(inputs)
         
         # Cache result
-        _embedding_cache[cache_key] = embedding
-        
-        return embedding
+        if provider.cacheable:
+            vectors = embedding_cache.put_many(inputs, provider.model, vectors)
+        else:
+            vectors = [np.asarray(v, dtype=np.float32) for v in vectors]
+        for indices, vector in zip(missing.values(), vectors):
+            for i in indices:
+                results[i] = vector
     except Exception as e:
         print(f"Errore generazione embedding: {e}")
-        return None
+    
+    # La cache conserva i vettori completi: il profilo si applica dopo,
+    # così cambiare EMBEDDING_DIMENSIONS non richiede nuove chiamate API
+    return [apply_profile(v) if v is not None else None for v in results]
+
+
+# Thread dedicati agli embeddings delle query di ricerca (chiamate di rete)
+_query_executor = ThreadPoolExecutor(
+    max_workers=settings.SEARCH_EMBEDDING_WORKERS,
+    thread_name_prefix="query-embedding"
+)
+
+
+def submit_query_embedding(text: str) -> Future:
+    """
+    Avvia generate_embedding in background e ritorna il Future.
+    Permette alla ricerca di eseguire FTS5 nel frattempo e di non
+    attendere oltre il proprio budget di latenza.
+    """
+    return _query_executor.submit(generate_embedding, text)
+
+
+def apply_profile(embedding, dimensions: Optional[int] = None) -> np.ndarray:
+    """
+    Riduce l'embedding alle prime `dimensions` componenti
+    (default settings.EMBEDDING_DIMENSIONS, 0 = dimensione nativa)
+    e lo rinormalizza. Per text-embedding-3 equivale al parametro
+    `dimensions` dell'API (embeddings Matryoshka).
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    dimensions = settings.EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+    if not dimensions or vector.shape[0] <= dimensions:
+        return vector
+    vector = vector[:dimensions]
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
 
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+def content_hash(text: str) -> str:
+    """
+    Hash del contenuto da cui deriva un embedding (modello + testo normalizzato).
+    Se non cambia, l'embedding salvato è ancora valido.
+    """
+    return cache_key(text, current_model())
+
+
+def cosine_similarity(vec1, vec2) -> float:
     """Calcola similarità coseno tra due vettori."""
-    a = np.array(vec1)
-    b = np.array(vec2)
+    a = np.asarray(vec1, dtype=np.float32)
+    b = np.asarray(vec2, dtype=np.float32)
     
     dot_product = np.dot(a, b)
     norm_a = np.linalg.norm(a)
@@ -73,13 +135,49 @@ def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     return float(dot_product / (norm_a * norm_b))
 
 
-def embedding_to_json(embedding: List[float]) -> str:
-    """Converte embedding in JSON string per storage."""
-    return json.dumps(embedding)
+def embedding_to_blob(
+    embedding,
+    dtype: Optional[str] = None,
+    quantization: Optional[str] = None
+) -> bytes:
+    """
+    Converte embedding in BLOB binario per storage.
+    Il dtype (default settings.EMBEDDING_DTYPE) determina la dimensione:
+    1536 float32 = 6 KB invece dei ~30 KB del formato JSON.
+    Con quantizzazione int8 (settings.EMBEDDING_QUANTIZATION) il BLOB è
+    la scala float32 seguita da un byte per componente.
+    """
+    quantization = quantization or settings.EMBEDDING_QUANTIZATION
+    if quantization == "int8":
+        codes, scales = quantize_int8(normalize(embedding))
+        return scales.tobytes() + codes[0].tobytes()
+    return np.asarray(embedding, dtype=dtype or settings.EMBEDDING_DTYPE).tobytes()
+
+
+def blob_to_embedding(
+    blob: bytes,
+    dtype: Optional[str] = None,
+    quantization: Optional[str] = None
+) -> Optional[np.ndarray]:
+    """
+    Converte BLOB in embedding senza copia (np.frombuffer).
+    L'array ritornato è read-only e condivide la memoria del BLOB.
+    I BLOB int8 vengono invece dequantizzati in un nuovo array float32.
+    """
+    if not blob:
+        return None
+    quantization = quantization or settings.EMBEDDING_QUANTIZATION
+    try:
+        if quantization == "int8":
+            scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+            return np.frombuffer(blob, dtype=np.int8, offset=4).astype(np.float32) * scale
+        return np.frombuffer(blob, dtype=dtype or settings.EMBEDDING_DTYPE)
+    except (TypeError, ValueError):
+        return None
 
 
 def json_to_embedding(json_str: str) -> Optional[List[float]]:
-    """Converte JSON string in embedding list."""
+    """Converte JSON string (formato legacy) in embedding list."""
     try:
         return json.loads(json_str)
     except Exception:
@@ -88,35 +186,147 @@ def json_to_embedding(json_str: str) -> Optional[List[float]]:
 
 def search_by_similarity(
     query_embedding: List[float],
-    items_with_embeddings: List[tuple],  # [(id, embedding_json), ...]
     threshold: float = 0.3,
-    limit: int = 20
+    limit: int = 20,
+    item_ids: Optional[List[int]] = None
 ) -> List[tuple]:
     """
-    Cerca items più simili per embedding.
+    Cerca items più simili per embedding nell'indice in memoria.
+    Usa l'indice IVF (se attivo) con nprobe = settings.ANN_NPROBE;
+    con item_ids valuta solo quegli items (ricerca per sottoalbero).
     Ritorna lista di (id, similarity_score) ordinata per rilevanza.
     """
-    results = []
+    return embedding_index.search(
+        query_embedding,
+        threshold=threshold,
+        limit=limit,
+        nprobe=settings.ANN_NPROBE,
+        item_ids=item_ids
+    )
+
+
+def search_many_by_similarity(
+    query_embeddings: List,
+    threshold: float = 0.3,
+    limit: int = 20
+) -> List[List[tuple]]:
+    """
+    Come search_by_similarity per più query insieme: un solo prodotto
+    matrice-matrice sull'indice. Ritorna una lista di risultati per query.
+    """
+    return embedding_index.search_many(
+        np.vstack([np.asarray(e, dtype=np.float32) for e in query_embeddings]),
+        threshold=threshold,
+        limit=limit,
+        nprobe=settings.ANN_NPROBE
+    )
+
+
+def load_index():
+    """
+    Carica nell'indice in memoria gli embeddings di tutti gli items attivi.
+    Chiamare all'avvio dell'applicazione e dopo rigenerazioni massive.
+    """
+    from ..database import SessionLocal, Item
     
-    for item_id, embedding_json in items_with_embeddings:
-        if not embedding_json:
-            continue
-        
-        item_embedding = json_to_embedding(embedding_json)
-        if not item_embedding:
-            continue
-        
-        similarity = cosine_similarity(query_embedding, item_embedding)
-        
-        if similarity >= threshold:
-            results.append((item_id, similarity))
+    db = SessionLocal()
+    try:
+        rows = db.query(Item.id, Item.embedding).filter(
+            Item.deleted_at.is_(None),
+            Item.embedding.isnot(None)
+        ).yield_per(1000)
+        embedding_index.load(
+            (item_id, blob_to_embedding(blob)) for item_id, blob in rows
+        )
+    finally:
+        db.close()
+    
+    _setup_ann()
+
+
+def _setup_ann():
+    """
+    Attiva l'indice IVF se abilitato e l'inventario è abbastanza grande.
+    Riusa centroidi e assegnazioni salvati in DATA_DIR; altrimenti
+    esegue il k-means e salva il risultato.
     
-    # Ordina per similarità decrescente
-    results.sort(key=lambda x: x[1], reverse=True)
+    In modalità auto (ANN_NLIST=0) il numero di cluster salvato viene
+    mantenuto anche se l'inventario è cresciuto: il k-means si rifà solo
+    al cambio di modello o con un /ann/rebuild esplicito.
+    """
+    if not settings.ANN_ENABLED or len(embedding_index) < settings.ANN_MIN_ITEMS:
+        return
+    
+    from .ann_index import IVFIndex
+    
+    saved = IVFIndex.load(settings.ANN_INDEX_PATH, model=current_model())
+    if saved is not None:
+        ivf, ids, lists = saved
+        nlist_ok = settings.ANN_NLIST <= 0 or ivf.nlist == settings.ANN_NLIST
+        if nlist_ok and embedding_index.attach_ivf(ivf, ids, lists):
+            return
     
-    return results[:limit]
+    train_ann_index()
+
+
+def _ann_nlist() -> int:
+    """Numero di cluster IVF: configurato o ~4 * sqrt(n)."""
+    if settings.ANN_NLIST > 0:
+        return settings.ANN_NLIST
+    return max(1, int(4 * math.sqrt(len(embedding_index))))
+
+
+def train_ann_index(nlist: Optional[int] = None) -> bool:
+    """(Ri)allena l'indice IVF sui vettori correnti e lo salva su disco."""
+    if not embedding_index.train_ivf(nlist or _ann_nlist()):
+        return False
+    save_ann_index()
+    return True
+
+
+def save_ann_index():
+    """
+    Salva centroidi e assegnazioni IVF su disco.
+    Chiamato dopo il training e allo shutdown, così le assegnazioni
+    degli items aggiunti nel frattempo non vanno ricalcolate.
+    """
+    state = embedding_index.ivf_state()
+    if state is None:
+        return
+    ivf, ids, lists = state
+    try:
+        ivf.save(settings.ANN_INDEX_PATH, ids, lists, model=current_model())
+    except Exception as e:
+        print(f"Errore salvataggio indice ANN: {e}")
+
+
+def measure_ann_recall(
+    nprobe: Optional[int] = None,
+    k: int = 10,
+    samples: int = 100
+) -> dict:
+    """Recall@k dell'indice IVF rispetto al brute force."""
+    return embedding_index.measure_recall(
+        nprobe=nprobe or settings.ANN_NPROBE,
+        k=k,
+        samples=samples
+    )
+
+
+def index_item(item_id: int, embedding_blob: Optional[bytes]):
+    """Sincronizza un item nell'indice in memoria dopo una scrittura."""
+    embedding = blob_to_embedding(embedding_blob)
+    if embedding is None:
+        embedding_index.remove(item_id)
+    else:
+        embedding_index.upsert(item_id, embedding)
+
+
+def unindex_item(item_id: int):
+    """Rimuove un item dall'indice in memoria (es. dopo soft delete)."""
+    embedding_index.remove(item_id)
 
 
 def is_semantic_search_available() -> bool:
     """Verifica se la ricerca semantica è disponibile."""
-    return bool(settings.OPENAI_API_KEY) and get_openai_client() is not None
+    return get_provider().is_available()
@@ -0,0 +1,268 @@
+"""
+Correzione dei typo nelle query FTS5.
+Il vocabolario dell'indice (vista fts5vocab `items_fts_vocab`) viene
+copiato nella tabella `fts_vocab` con un indice di trigrammi
+(`fts_vocab_trigrams`): i termini della query che non corrispondono a
+nessuna parola indicizzata vengono sostituiti dal termine noto più
+vicino (distanza di Levenshtein limitata), prima di eseguire FTS5.
+Il riallineamento delle tabelle avviene in background dopo le scritture:
+la ricerca legge soltanto.
+"""
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from .search_cache import data_generation
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_MAX_CANDIDATES = 100
+
+# Un solo thread: i refresh non si sovrappongono
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fuzzy-vocab")
+
+
+def fold(term: str) -> str:
+    """Minuscolo e senza accenti, come il tokenizer unicode61 remove_diacritics."""
+    decomposed = unicodedata.normalize("NFKD", term.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def trigrams(term: str) -> Set[str]:
+    """Trigrammi del termine con bordi ("$ca", "cac", ..., "te$")."""
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_levenshtein(a: str, b: str, max_distance: int) -> Optional[int]:
+    """
+    Distanza di edit tra a e b, o None se supera max_distance.
+    Interrompe il calcolo appena un'intera riga supera il limite.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        if min(current) > max_distance:
+            return None
+        previous = current
+
+    distance = previous[-1]
+    return distance if distance <= max_distance else None
+
+
+class FuzzyVocabulary:
+    """
+    Vocabolario con trigrammi per la correzione dei termini.
+    L'aggiornamento gira in background, richiesto dopo ogni scrittura
+    (bump_data_generation) e applica alle tabelle solo la differenza di
+    termini; le richieste ravvicinate si accorpano in un solo refresh.
+    Fino al suo completamento la ricerca usa il vocabolario precedente.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation: Optional[int] = None
+        self._scheduled = False
+        self.corrections = 0
+
+    @staticmethod
+    def enabled() -> bool:
+        """Solo con unicode61: con trigram il vocabolario non contiene parole."""
+        return settings.FUZZY_SEARCH_ENABLED and settings.FTS_TOKENIZER == "unicode61"
+
+    def rewrite(self, q: str, db: Session) -> str:
+        """
+        Ritorna la query con i termini sconosciuti sostituiti dal termine
+        indicizzato più vicino; invariata se non serve nessuna correzione.
+        Il resto del testo (punteggiatura, operatori, altri termini)
+        resta com'era.
+        """
+        if not self.enabled():
+            return q
+
+        tokens = {fold(token) for token in _TOKEN.findall(q)}
+        unknown = [
+            token for token in sorted(tokens)
+            if len(token) >= settings.FUZZY_MIN_TERM_LENGTH
+            and not any(c.isdigit() for c in token)
+            and not _has_prefix_match(token, db)
+        ]
+        if not unknown:
+            return q
+
+        if self._generation != data_generation.value:
+            self.schedule_refresh()
+        replacements = {}
+        for token in unknown:
+            best = self.closest_term(token, db)
+            if best is not None:
+                replacements[token] = best
+        if not replacements:
+            return q
+
+        self.corrections += len(replacements)
+        return _TOKEN.sub(
+            lambda match: replacements.get(fold(match.group()), match.group()),
+            q
+        )
+
+    def closest_term(self, token: str, db: Session) -> Optional[str]:
+        """
+        Termine del vocabolario più vicino a `token`: candidati dai
+        trigrammi condivisi, poi Levenshtein limitato; a parità di
+        distanza vince il termine presente in più items.
+        """
+        max_distance = min(
+            settings.FUZZY_MAX_DISTANCE,
+            1 if len(token) <= 5 else 2
+        )
+        rows = db.execute(
+            text(
+                "SELECT fts_vocab.term, fts_vocab.doc "
+                "FROM fts_vocab_trigrams "
+                "JOIN fts_vocab ON fts_vocab.term = fts_vocab_trigrams.term "
+                "WHERE fts_vocab_trigrams.trigram IN :trigrams "
+                "AND length(fts_vocab.term) BETWEEN :min_length AND :max_length "
+                "GROUP BY fts_vocab.term "
+                "ORDER BY COUNT(*) DESC, fts_vocab.doc DESC "
+                "LIMIT :limit"
+            ).bindparams(bindparam("trigrams", expanding=True)),
+            {
+                "trigrams": sorted(trigrams(token)),
+                "min_length": len(token) - max_distance,
+                "max_length": len(token) + max_distance,
+                "limit": _MAX_CANDIDATES
+            }
+        ).fetchall()
+
+        best, best_key = None, None
+        for term, doc in rows:
+            distance = bounded_levenshtein(token, term, max_distance)
+            if distance is None:
+                continue
+            key = (distance, -doc)
+            if best_key is None or key < best_key:
+                best, best_key = term, key
+        return best
+
+    def schedule_refresh(self):
+        """
+        Richiede un riallineamento in background. Al massimo uno in coda:
+        le scritture arrivate durante un refresh ne accodano un altro.
+        """
+        if not self.enabled():
+            return
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        _refresh_executor.submit(self._refresh_in_background)
+
+    def _refresh_in_background(self):
+        """Refresh su una connessione propria (BackgroundSessionLocal)."""
+        from ..database import BackgroundSessionLocal
+
+        with self._lock:
+            self._scheduled = False
+        generation = data_generation.value
+        if self._generation == generation:
+            return
+
+        db = BackgroundSessionLocal()
+        try:
+            self.refresh(db)
+            self._generation = generation
+        except Exception as e:
+            db.rollback()
+            print(f"Errore aggiornamento vocabolario fuzzy: {e}")
+        finally:
+            db.close()
+
+    def refresh(self, db: Session) -> Dict[str, int]:
+        """
+        Applica a fts_vocab / fts_vocab_trigrams la differenza rispetto
+        a fts5vocab: inserisce i termini nuovi con i loro trigrammi,
+        rimuove quelli spariti e aggiorna i conteggi.
+        """
+        current = dict(db.execute(text(
+            "SELECT term, doc FROM items_fts_vocab"
+        )).fetchall())
+        stored = dict(db.execute(text(
+            "SELECT term, doc FROM fts_vocab"
+        )).fetchall())
+
+        added = [term for term in current if term not in stored]
+        removed = [term for term in stored if term not in current]
+        changed = [
+            term for term, doc in current.items()
+            if term in stored and stored[term] != doc
+        ]
+
+        if removed:
+            db.execute(
+                text("DELETE FROM fts_vocab WHERE term IN :terms")
+                .bindparams(bindparam("terms", expanding=True)),
+                {"terms": removed}
+            )
+            db.execute(
+                text("DELETE FROM fts_vocab_trigrams WHERE term IN :terms")
+                .bindparams(bindparam("terms", expanding=True)),
+                {"terms": removed}
+            )
+        if added or changed:
+            db.execute(
+                text("INSERT OR REPLACE INTO fts_vocab (term, doc) VALUES (:term, :doc)"),
+                [{"term": term, "doc": current[term]} for term in added + changed]
+            )
+        if added:
+            db.execute(
+                text(
+                    "INSERT OR IGNORE INTO fts_vocab_trigrams (trigram, term) "
+                    "VALUES (:trigram, :term)"
+                ),
+                [
+                    {"trigram": trigram, "term": term}
+                    for term in added for trigram in trigrams(term)
+                ]
+            )
+        db.commit()
+
+        return {"added": len(added), "removed": len(removed), "changed": len(changed)}
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled(),
+            "generation": self._generation,
+            "corrections": self.corrections
+        }
+
+
+def _has_prefix_match(token: str, db: Session) -> bool:
+    """True se almeno un termine indicizzato inizia con `token`."""
+    row = db.execute(
+        text(
+            "SELECT 1 FROM items_fts_vocab "
+            "WHERE term >= :low AND term < :high LIMIT 1"
+        ),
+        {"low": token, "high": token + "\U0010ffff"}
+    ).fetchone()
+    return row is not None
+
+
+# Istanza condivisa dal processo
+fuzzy_vocabulary = FuzzyVocabulary()
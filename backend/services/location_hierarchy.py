@@ -0,0 +1,422 @@
+"""
+Query sulla gerarchia delle locations e sul loro contenuto.
+La gerarchia è indicizzata dal percorso materializzato
+`locations.path` ("/1/5/12/": antenati + la location stessa, indice
+idx_locations_path), mantenuto dagli endpoint locations:
+- discendenti: un range scan sul prefisso del percorso
+- antenati: gli ID sono già nel percorso, una lookup per chiave
+Usate dalla ricerca per restringere i risultati al sottoalbero di una
+location, dentro il retrieval (SQL e indice semantico) e non filtrando
+a posteriori un top-k globale.
+I conteggi degli items per location sono calcolati con un solo
+GROUP BY sull'indice idx_items_location_counts.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+
+
+# Albero delle locations attive con profondità e percorso dei nomi.
+# Radici: senza parent o con parent eliminato/inesistente; con root_id
+# si parte da quella location. id_path impedisce di ripercorrere un ciclo.
+_TREE_SQL = """
+    WITH RECURSIVE tree(id, name, description, parent_id, created_at,
+                        depth, path, id_path) AS (
+        SELECT id, name, description, parent_id, created_at,
+               0, :root_path, '/' || id || '/'
+        FROM locations
+        WHERE deleted_at IS NULL AND {root_filter}
+        UNION ALL
+        SELECT
+            locations.id,
+            locations.name,
+            locations.description,
+            locations.parent_id,
+            locations.created_at,
+            tree.depth + 1,
+            CASE WHEN tree.path = '' THEN tree.name
+                 ELSE tree.path || ' / ' || tree.name END,
+            tree.id_path || locations.id || '/'
+        FROM locations JOIN tree ON locations.parent_id = tree.id
+        WHERE locations.deleted_at IS NULL
+          AND tree.depth < 64
+          AND instr(tree.id_path, '/' || locations.id || '/') = 0
+    )
+    SELECT * FROM tree ORDER BY depth, name
+"""
+
+_ROOTS_FILTER = (
+    "(parent_id IS NULL OR parent_id NOT IN "
+    "(SELECT id FROM locations WHERE deleted_at IS NULL))"
+)
+
+
+# ============== Percorso materializzato ==============
+
+def child_path(parent_path: Optional[str], location_id: int) -> str:
+    """Percorso di una location dato quello del parent (None = radice)."""
+    return f"{parent_path or '/'}{location_id}/"
+
+
+def path_ids(path: Optional[str]) -> List[int]:
+    """ID contenuti in un percorso, dalla radice alla location."""
+    if not path:
+        return []
+    return [int(part) for part in path.strip("/").split("/") if part]
+
+
+def subtree_range(path: str) -> Tuple[str, str]:
+    """
+    Estremi [low, high) dei percorsi che iniziano con `path`.
+    I percorsi contengono solo cifre e "/", e "0" segue "/" in ASCII:
+    il range è servito dall'indice (LIKE 'x%' non lo userebbe).
+    """
+    return path, path[:-1] + "0"
+
+
+def path_for(db: Session, parent_id: Optional[int], location_id: int) -> str:
+    """Percorso di una nuova location sotto parent_id."""
+    parent_path = None
+    if parent_id is not None:
+        row = db.execute(
+            text("SELECT path FROM locations WHERE id = :id"),
+            {"id": parent_id}
+        ).fetchone()
+        parent_path = row.path if row else None
+    return child_path(parent_path, location_id)
+
+
+def move_subtree(db: Session, location, parent_id: int):
+    """
+    Sposta `location` (con tutto il sottoalbero) sotto parent_id:
+    controlla che il parent esista e che non sia un discendente
+    (ciclo), poi riscrive i percorsi con un solo UPDATE sul range del
+    vecchio prefisso. Solleva ValueError se lo spostamento non è valido.
+    Non esegue il commit.
+    """
+    parent = db.execute(
+        text("SELECT path FROM locations WHERE id = :id AND deleted_at IS NULL"),
+        {"id": parent_id}
+    ).fetchone()
+    if parent is None:
+        raise ValueError("Parent location non valido")
+    if parent_id == location.id or location.id in path_ids(parent.path):
+        raise ValueError("Una location non può essere spostata dentro se stessa")
+
+    old_path = location.path or child_path(None, location.id)
+    new_path = child_path(parent.path, location.id)
+    low, high = subtree_range(old_path)
+    # Anche le discendenti eliminate: restano coerenti se riattivate
+    db.execute(
+        text(
+            "UPDATE locations SET path = :new_path || substr(path, :cut) "
+            "WHERE path >= :low AND path < :high"
+        ),
+        {"new_path": new_path, "cut": len(old_path) + 1, "low": low, "high": high}
+    )
+    location.parent_id = parent_id
+
+
+# ============== Eliminazione e ripristino del sottoalbero ==============
+
+# Locations del sottoalbero eliminate con `stamp` (stessa operazione)
+_DELETED_SUBTREE = (
+    "SELECT id FROM locations "
+    "WHERE path >= :low AND path < :high AND deleted_at = :stamp"
+)
+
+# Items che appartengono a quelle locations: contenuti e in mano
+# (location_id NULL, previous_location_id = location da cui sono stati presi)
+_ITEMS_OF_DELETED_SUBTREE = (
+    f"(location_id IN ({_DELETED_SUBTREE}) "
+    f"OR (location_id IS NULL AND previous_location_id IN ({_DELETED_SUBTREE})))"
+)
+
+
+def soft_delete_subtree(db: Session, path: str, stamp: datetime) -> Tuple[List, List]:
+    """
+    Soft delete della location con percorso `path`, delle discendenti
+    attive e dei loro items: un UPDATE per tabella sul range del
+    percorso, tutti con lo stesso `stamp` (che identifica l'operazione
+    per il ripristino). Non esegue il commit.
+    Gli items in mano presi da una di queste locations vengono eliminati
+    anch'essi (come nei conteggi appartengono alla location d'origine):
+    restano così ripristinabili insieme a lei, con previous_location_id
+    intatto, invece di restare in mano con un'origine eliminata.
+    Ritorna (locations [(id, name)], items [(id, description)]).
+    """
+    low, high = subtree_range(path)
+    params = {"low": low, "high": high, "stamp": stamp}
+
+    locations = db.execute(
+        text(
+            "UPDATE locations SET deleted_at = :stamp "
+            "WHERE path >= :low AND path < :high AND deleted_at IS NULL "
+            "RETURNING id, name"
+        ).bindparams(bindparam("stamp", type_=DateTime())),
+        params
+    ).fetchall()
+
+    # Solo gli items delle locations eliminate ora (stesso stamp): quelli
+    # di sotto-locations già eliminate in precedenza non vengono toccati
+    items = db.execute(
+        text(
+            "UPDATE items SET deleted_at = :stamp "
+            f"WHERE deleted_at IS NULL AND {_ITEMS_OF_DELETED_SUBTREE} "
+            "RETURNING id, description"
+        ).bindparams(bindparam("stamp", type_=DateTime())),
+        params
+    ).fetchall()
+
+    return (
+        [(row.id, row.name) for row in locations],
+        [(row.id, row.description) for row in items]
+    )
+
+
+def restore_subtree(db: Session, location_id: int, path: str) -> Tuple[List, List]:
+    """
+    Ripristina quanto eliminato insieme alla location: locations del
+    sottoalbero e items (anche quelli in mano) con lo stesso deleted_at
+    della location (eliminazioni precedenti o successive restano tali).
+    Due UPDATE, nessun commit.
+    Ritorna (locations [(id, name)], items [(id, description,
+    embedding, embedding_status)]) per riallineare gli indici in memoria.
+    """
+    # Valore grezzo di deleted_at (stesso formato delle righe da confrontare)
+    row = db.execute(
+        text("SELECT deleted_at FROM locations WHERE id = :id"),
+        {"id": location_id}
+    ).fetchone()
+    if row is None or row.deleted_at is None:
+        return [], []
+
+    low, high = subtree_range(path)
+    params = {"low": low, "high": high, "stamp": row.deleted_at}
+
+    # Prima gli items: il filtro usa il deleted_at delle locations
+    items = db.execute(
+        text(
+            "UPDATE items SET deleted_at = NULL "
+            f"WHERE deleted_at = :stamp AND {_ITEMS_OF_DELETED_SUBTREE} "
+            "RETURNING id, description, embedding, embedding_status"
+        ),
+        params
+    ).fetchall()
+
+    locations = db.execute(
+        text(
+            "UPDATE locations SET deleted_at = NULL "
+            "WHERE path >= :low AND path < :high AND deleted_at = :stamp "
+            "RETURNING id, name"
+        ),
+        params
+    ).fetchall()
+
+    return (
+        [(row.id, row.name) for row in locations],
+        [
+            (row.id, row.description, row.embedding, row.embedding_status)
+            for row in items
+        ]
+    )
+
+
+# ============== Antenati e discendenti ==============
+
+def ancestors(
+    db: Session,
+    location_id: int,
+    path: Optional[str] = None
+) -> List[Tuple[int, str]]:
+    """
+    [(id, nome), ...] degli antenati dalla radice al parent diretto,
+    letti per chiave dagli ID del percorso. Una location eliminata
+    interrompe la catena: restano solo gli antenati sotto di essa.
+    path: percorso della location se già letto (risparmia una query).
+    """
+    if path is None:
+        row = db.execute(
+            text("SELECT path FROM locations WHERE id = :id"),
+            {"id": location_id}
+        ).fetchone()
+        path = row.path if row else None
+    ids = path_ids(path)[:-1]
+    if not ids:
+        return []
+
+    rows = db.execute(
+        text(
+            "SELECT id, name, deleted_at FROM locations WHERE id IN :ids"
+        ).bindparams(bindparam("ids", expanding=True)),
+        {"ids": ids}
+    ).fetchall()
+    by_id = {r.id: r for r in rows}
+
+    chain = []
+    for ancestor_id in ids:
+        ancestor = by_id.get(ancestor_id)
+        if ancestor is None or ancestor.deleted_at is not None:
+            chain = []
+            continue
+        chain.append((ancestor.id, ancestor.name))
+    return chain
+
+
+def location_tree(db: Session, root_id: Optional[int] = None) -> List:
+    """
+    Righe dell'albero (o del sottoalbero di root_id) con una sola CTE
+    ricorsiva, ordinate per profondità: id, name, description,
+    parent_id, created_at, depth (0 = radice richiesta), path
+    (nomi degli antenati separati da " / "), id_path ("/1/5/12/").
+    """
+    if root_id is None:
+        sql = _TREE_SQL.format(root_filter=_ROOTS_FILTER)
+        return db.execute(text(sql), {"root_path": ""}).fetchall()
+
+    root_path = " / ".join(name for _, name in ancestors(db, root_id))
+    sql = _TREE_SQL.format(root_filter="id = :root_id")
+    return db.execute(
+        text(sql), {"root_path": root_path, "root_id": root_id}
+    ).fetchall()
+
+
+def location_exists(db: Session, location_id: int) -> bool:
+    """True se la location esiste e non è eliminata."""
+    row = db.execute(
+        text("SELECT 1 FROM locations WHERE id = :id AND deleted_at IS NULL"),
+        {"id": location_id}
+    ).fetchone()
+    return row is not None
+
+
+def subtree_location_ids(
+    db: Session,
+    location_id: int,
+    include_descendants: bool = True
+) -> List[int]:
+    """
+    ID della location e (se richiesto) di tutte le sue discendenti
+    attive, con un range scan su idx_locations_path. Le discendenti
+    di una location eliminata sono escluse.
+    Lista vuota se la location non esiste o è eliminata.
+    """
+    row = db.execute(
+        text("SELECT path FROM locations WHERE id = :id AND deleted_at IS NULL"),
+        {"id": location_id}
+    ).fetchone()
+    if row is None:
+        return []
+    if not include_descendants or not row.path:
+        return [location_id]
+
+    low, high = subtree_range(row.path)
+    rows = db.execute(
+        text(
+            "SELECT id, path, deleted_at FROM locations "
+            "WHERE path >= :low AND path < :high"
+        ),
+        {"low": low, "high": high}
+    ).fetchall()
+
+    deleted = {r.path for r in rows if r.deleted_at is not None}
+    return [
+        r.id for r in rows
+        if r.deleted_at is None
+        and not any(r.path.startswith(prefix) for prefix in deleted)
+    ]
+
+
+def item_ids_in_locations(db: Session, location_ids: List[int]) -> List[int]:
+    """ID degli items attivi contenuti nelle locations indicate."""
+    if not location_ids:
+        return []
+
+    rows = db.execute(
+        text(
+            "SELECT id FROM items "
+            "WHERE location_id IN :location_ids AND deleted_at IS NULL"
+        ).bindparams(bindparam("location_ids", expanding=True)),
+        {"location_ids": location_ids}
+    )
+    return [row.id for row in rows]
+
+
+# Location "di casa" di un item: quella da cui è stato preso se in mano
+_HOME_LOCATION = (
+    "CASE WHEN status = 'IN_HAND' "
+    "THEN coalesce(location_id, previous_location_id) "
+    "ELSE location_id END"
+)
+
+_COUNTED_STATUSES = {
+    "AVAILABLE": "available",
+    "IN_HAND": "in_hand",
+    "LOANED": "loaned",
+    "LOST": "lost",
+}
+
+
+def empty_counts() -> dict:
+    """Conteggi di una location senza items."""
+    counts = {"total": 0}
+    counts.update({key: 0 for key in _COUNTED_STATUSES.values()})
+    return counts
+
+
+def item_counts(
+    db: Session,
+    location_ids: Optional[List[int]] = None
+) -> Dict[int, dict]:
+    """
+    Conteggi degli items attivi per location con un solo GROUP BY:
+    {location_id: {"total", "available", "in_hand", "loaned", "lost"}}.
+    - total: items con location_id = location (come la tasca digitale
+      li toglie dalla scatola, gli items in mano non sono inclusi)
+    - per stato: gli items in mano contano nella location da cui sono
+      stati presi (previous_location_id)
+    location_ids: limita il calcolo a queste locations (None = tutte).
+    Le locations senza items non compaiono: usare empty_counts().
+    """
+    if location_ids is not None and not location_ids:
+        return {}
+
+    location_filter = ""
+    if location_ids is not None:
+        location_filter = (
+            "AND (location_id IN :location_ids "
+            "OR (location_id IS NULL AND previous_location_id IN :location_ids))"
+        )
+    sql = text(f"""
+        SELECT
+            {_HOME_LOCATION} AS home_id,
+            status,
+            location_id IS NOT NULL AS placed,
+            COUNT(*) AS n
+        FROM items
+        WHERE deleted_at IS NULL
+          {location_filter}
+        GROUP BY home_id, status, placed
+    """)
+    params = {}
+    if location_ids is not None:
+        sql = sql.bindparams(bindparam("location_ids", expanding=True))
+        params["location_ids"] = location_ids
+
+    counts: Dict[int, dict] = {}
+    for row in db.execute(sql, params):
+        if row.home_id is None:
+            continue
+        entry = counts.setdefault(row.home_id, empty_counts())
+        if row.placed:
+            entry["total"] += row.n
+        key = _COUNTED_STATUSES.get(row.status)
+        if key is not None:
+            entry[key] += row.n
+
+    if location_ids is not None:
+        wanted = set(location_ids)
+        counts = {lid: c for lid, c in counts.items() if lid in wanted}
+    return counts
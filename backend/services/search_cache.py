@@ -0,0 +1,163 @@
+"""
+Cache dei risultati di ricerca con invalidazione guidata dalle scritture.
+Ogni scrittura su items/locations incrementa un contatore globale di
+generazione dei dati: una voce in cache è valida solo se è stata
+calcolata nella generazione corrente. Lo stesso contatore produce gli
+ETag delle risposte HTTP derivate dai dati (pagina QR delle locations).
+"""
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from ..config import settings
+
+
+class DataGeneration:
+    """Contatore monotono delle modifiche ai dati (per processo)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+        self.boot_id = uuid.uuid4().hex[:12]  # Diverso ad ogni avvio del processo
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def etag(self, *parts) -> str:
+        """
+        ETag debole: processo + generazione corrente + `parts` (ID e
+        parametri della risposta). Da calcolare prima di leggere i dati.
+        Cambia comunque ogni SEARCH_CACHE_TTL_SECONDS, come la cache dei
+        risultati, così con più worker uvicorn la staleness resta limitata.
+        Con TTL <= 0 (cache disattivata) la finestra temporale è omessa.
+        """
+        head = (self.boot_id, self._value)
+        if settings.SEARCH_CACHE_TTL_SECONDS > 0:
+            head += (int(time.time() // settings.SEARCH_CACHE_TTL_SECONDS),)
+        tag = "-".join(str(part) for part in head + parts)
+        return f'W/"{tag}"'
+
+    def bump(self) -> int:
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+_ENTITY_TAG = re.compile(r'\s*(?:W/)?"([^"]*)"\s*(?:,|$)')
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Confronto debole (RFC 9110) tra l'header If-None-Match e un ETag:
+    lista di tag separati da virgola, prefisso W/ ignorato, `*` corrisponde
+    a qualsiasi rappresentazione. Header malformati non corrispondono.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    opaque = opaque.strip('"')
+    
+    pos = 0
+    while pos < len(if_none_match):
+        match = _ENTITY_TAG.match(if_none_match, pos)
+        if match is None:
+            return False
+        if match.group(1) == opaque:
+            return True
+        pos = match.end()
+    return False
+
+
+class SearchResultCache:
+    """
+    LRU limitata per numero di voci. Le voci scadono anche dopo
+    `ttl_seconds`, così con più worker uvicorn (contatori separati)
+    la staleness resta comunque limitata.
+    """
+
+    def __init__(self, generation: DataGeneration, max_entries: int, ttl_seconds: float):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._generation = generation
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, stored_at, value = entry
+                if (
+                    generation == self._generation.value
+                    and time.monotonic() - stored_at < self.ttl_seconds
+                ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        """
+        Salva un risultato calcolato nella generazione `generation`
+        (letta prima di eseguire la ricerca, per non salvare come
+        fresco un risultato calcolato durante una scrittura).
+        """
+        with self._lock:
+            if generation != self._generation.value:
+                return
+            self._entries[key] = (generation, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "generation": self._generation.value,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None
+            }
+
+
+# Istanze condivise dal processo
+data_generation = DataGeneration()
+search_cache = SearchResultCache(
+    data_generation,
+    max_entries=settings.SEARCH_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.SEARCH_CACHE_TTL_SECONDS
+)
+
+
+def bump_data_generation():
+    """
+    Da chiamare dopo ogni scrittura su items/locations: invalida
+    tutti i risultati di ricerca in cache e accoda il riallineamento
+    del vocabolario fuzzy.
+    """
+    from .fuzzy_search import fuzzy_vocabulary
+    
+    data_generation.bump()
+    search_cache.clear()
+    fuzzy_vocabulary.schedule_refresh()
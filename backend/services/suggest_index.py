@@ -0,0 +1,150 @@
+"""
+Indice in memoria per l'autocompletamento della barra di ricerca.
+Lista ordinata dei termini (descrizioni degli items e nomi delle
+locations attivi) con le loro frequenze: un prefisso individua con
+bisect l'intervallo dei termini che lo completano, senza toccare
+SQLite né il provider di embeddings.
+"""
+import bisect
+import heapq
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .fuzzy_search import fold
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_MIN_TERM_LENGTH = 2
+_CACHED_PREFIX_LENGTH = 2  # Prefissi corti: intervalli ampi, risultato in cache
+
+
+def _terms(value: Optional[str]) -> List[Tuple[str, str]]:
+    """Coppie (chiave normalizzata, forma da mostrare) dei termini di un testo."""
+    if not value:
+        return []
+    return [
+        (fold(token), token.lower())
+        for token in _TOKEN.findall(value)
+        if len(token) >= _MIN_TERM_LENGTH
+    ]
+
+
+class SuggestIndex:
+    """
+    Termini ordinati per chiave (minuscolo, senza accenti) con conteggio
+    delle occorrenze. Caricato all'avvio e aggiornato dalle scritture
+    degli endpoint items/locations (ogni worker ha la propria copia).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: List[str] = []           # chiavi ordinate
+        self._counts: Dict[str, int] = {}    # chiave -> occorrenze
+        self._display: Dict[str, str] = {}   # chiave -> forma da mostrare
+        self._short: Dict[Tuple[str, int], List[Tuple[str, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, texts: Iterable[Optional[str]]):
+        """Sostituisce il contenuto con i termini dei testi indicati."""
+        counts: Dict[str, int] = {}
+        display: Dict[str, str] = {}
+        for value in texts:
+            for key, shown in _terms(value):
+                counts[key] = counts.get(key, 0) + 1
+                display.setdefault(key, shown)
+
+        with self._lock:
+            self._keys = sorted(counts)
+            self._counts = counts
+            self._display = display
+            self._short.clear()
+
+    def add(self, value: Optional[str]):
+        """Conta i termini di un testo nuovo (item creato, location rinominata...)."""
+        with self._lock:
+            self._short.clear()
+            for key, shown in _terms(value):
+                if key not in self._counts:
+                    bisect.insort(self._keys, key)
+                    self._counts[key] = 0
+                    self._display[key] = shown
+                self._counts[key] += 1
+
+    def remove(self, value: Optional[str]):
+        """Scala i termini di un testo rimosso; i termini a zero spariscono."""
+        with self._lock:
+            self._short.clear()
+            for key, _ in _terms(value):
+                count = self._counts.get(key)
+                if count is None:
+                    continue
+                if count > 1:
+                    self._counts[key] = count - 1
+                    continue
+                del self._counts[key]
+                del self._display[key]
+                position = bisect.bisect_left(self._keys, key)
+                if position < len(self._keys) and self._keys[position] == key:
+                    del self._keys[position]
+
+    def replace(self, old: Optional[str], new: Optional[str]):
+        """Aggiorna i conteggi dopo la modifica di un testo."""
+        if old == new:
+            return
+        self.remove(old)
+        self.add(new)
+
+    def suggest(self, prefix: str, limit: int = 8) -> List[Tuple[str, int]]:
+        """
+        Completamenti di `prefix`: [(termine, occorrenze), ...] ordinati
+        per frequenza decrescente, poi alfabeticamente.
+        """
+        key = fold(prefix.strip())
+        if not key:
+            return []
+
+        with self._lock:
+            cached = self._short.get((key, limit))
+            if cached is not None:
+                return cached
+
+            start = bisect.bisect_left(self._keys, key)
+            end = bisect.bisect_left(self._keys, key + "\U0010ffff", lo=start)
+            best = heapq.nsmallest(
+                limit,
+                self._keys[start:end],
+                key=lambda k: (-self._counts[k], k)
+            )
+            result = [(self._display[k], self._counts[k]) for k in best]
+
+            # I prefissi di 1-2 caratteri coprono migliaia di termini:
+            # il risultato resta valido fino alla prossima scrittura
+            if len(key) <= _CACHED_PREFIX_LENGTH:
+                self._short[(key, limit)] = result
+            return result
+
+
+def load_suggest_index():
+    """Costruisce l'indice da items e locations attivi (all'avvio)."""
+    from ..database import SessionLocal, Item, Location
+
+    db = SessionLocal()
+    try:
+        descriptions = db.query(Item.description).filter(
+            Item.deleted_at.is_(None),
+            Item.description.isnot(None)
+        ).yield_per(1000)
+        names = db.query(Location.name).filter(Location.deleted_at.is_(None))
+        suggest_index.load(
+            [row.description for row in descriptions]
+            + [row.name for row in names]
+        )
+    finally:
+        db.close()
+
+
+# Istanza condivisa dal processo
+suggest_index = SuggestIndex()
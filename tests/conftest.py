@@ -0,0 +1,29 @@
+"""
+Configurazione comune dei test: database e DATA_DIR temporanei,
+provider di embeddings locale (nessuna rete).
+Le variabili vanno impostate prima di importare `backend`.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="kaos-test-")
+os.environ.setdefault("EMBEDDING_PROVIDER", "local")
+os.environ.setdefault("SEARCH_SEMANTIC_BUDGET_MS", "5000")
+os.environ.setdefault("SEARCH_CACHE_TTL_SECONDS", "0")  # Niente cache: ogni ricerca va al DB
+
+
+@pytest.fixture(scope="session")
+def client():
+    """TestClient con lifespan attivo (init database, indici, worker)."""
+    from fastapi.testclient import TestClient
+    from backend.main import app
+    
+    with TestClient(app) as test_client:
+        yield test_client
@@ -0,0 +1,67 @@
+"""
+Recall dell'indice semantico su vettori sintetici: riproduce le misure
+di ANN_NPROBE (IVF vs brute force, con e senza int8) e dei profili
+ridotti/quantizzati (EMBEDDING_DIMENSIONS, EMBEDDING_QUANTIZATION).
+"""
+import math
+
+import numpy as np
+import pytest
+
+from backend.config import settings
+from backend.services.embedding_index import EmbeddingIndex
+from backend.services.embeddings import apply_profile
+
+
+def clustered_vectors(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """Vettori raggruppati attorno a `clusters` centri (come descrizioni simili)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    return centers[rng.integers(clusters, size=n)] + 0.3 * rng.standard_normal((n, dim))
+
+
+def decaying_vectors(n: int, dim: int, seed: int = 1) -> np.ndarray:
+    """Varianza decrescente per componente, come gli embeddings Matryoshka."""
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n, dim)) * np.exp(-np.arange(dim) / 300)
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+def test_ivf_recall_at_default_nprobe(quantization):
+    n = 20000
+    index = EmbeddingIndex(quantization=quantization)
+    index.load(enumerate(clustered_vectors(n, 128, clusters=200), start=1))
+    index.train_ivf(max(1, int(4 * math.sqrt(n))))  # nlist automatico (ANN_NLIST=0)
+
+    report = index.measure_recall(nprobe=settings.ANN_NPROBE, k=10, samples=200)
+
+    assert report["nlist"] == 565
+    assert report["recall"] >= 0.99, report
+
+
+@pytest.mark.parametrize("dimensions, quantization, min_recall", [
+    (1536, "int8", 0.97),
+    (512, "none", 0.93),
+    (512, "int8", 0.93),
+    (256, "none", 0.75),
+    (256, "int8", 0.75),
+])
+def test_profile_recall_against_full_float32(dimensions, quantization, min_recall):
+    vectors = decaying_vectors(5000, 1536)
+    queries = vectors[np.random.default_rng(2).choice(len(vectors), 100, replace=False)]
+
+    exact = EmbeddingIndex()
+    exact.load(enumerate(vectors, start=1))
+    profiled = EmbeddingIndex(quantization=quantization)
+    profiled.load(
+        (item_id, apply_profile(vector, dimensions))
+        for item_id, vector in enumerate(vectors, start=1)
+    )
+
+    hits = 0
+    for query in queries:
+        expected = {i for i, _ in exact.search(query, threshold=-1.0, limit=10)}
+        found = profiled.search(apply_profile(query, dimensions), threshold=-1.0, limit=10)
+        hits += len(expected & {i for i, _ in found})
+
+    assert hits / (10 * len(queries)) >= min_recall
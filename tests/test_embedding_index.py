@@ -0,0 +1,87 @@
+"""
+Concorrenza dell'indice in memoria: ricerche in parallelo tra loro,
+scritture esclusive e risultati coerenti durante upsert/remove.
+"""
+import threading
+
+import numpy as np
+
+from backend.services.embedding_index import EmbeddingIndex, ReadWriteLock
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    acquired = threading.Event()
+
+    def second_reader():
+        with lock.read():
+            acquired.set()
+
+    with lock.read():
+        thread = threading.Thread(target=second_reader)
+        thread.start()
+        assert acquired.wait(timeout=1)  # Non attende il primo lettore
+    thread.join()
+
+
+def test_writer_waits_for_readers():
+    events = []
+    lock = ReadWriteLock()
+    reading = threading.Event()
+    release = threading.Event()
+
+    def reader():
+        with lock.read():
+            reading.set()
+            release.wait()
+            events.append("read")
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    reading.wait()
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    writer_thread.join(timeout=0.2)
+    assert writer_thread.is_alive()  # Attende la fine della lettura
+
+    release.set()
+    reader_thread.join()
+    writer_thread.join()
+    assert events == ["read", "write"]
+
+
+def test_search_is_consistent_during_writes():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 64))
+    index = EmbeddingIndex()
+    index.load(enumerate(vectors, start=1))
+    removed = set(range(1, 1001))
+    errors = []
+
+    def writer():
+        for item_id in sorted(removed):
+            index.remove(item_id)
+            index.upsert(5000 + item_id, vectors[item_id - 1])
+
+    def searcher():
+        try:
+            for query in vectors[1000:1100]:
+                ids = [item_id for item_id, _ in index.search(query, threshold=-1.0, limit=50)]
+                assert len(ids) == len(set(ids)), "Item duplicato nei risultati"
+        except AssertionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=searcher) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(index) == 2000
+    assert not any(item_id in index for item_id in removed)
@@ -0,0 +1,71 @@
+"""
+Numero di query SQL per ricerca: l'idratazione dei risultati è batch,
+quindi 1 risultato o N risultati costano lo stesso numero di statement.
+"""
+import pytest
+from sqlalchemy import event
+
+from backend.database.connection import engine
+from backend.services.embedding_worker import process_pending_batch
+
+N_ITEMS = 12
+
+
+class StatementCounter:
+    """Conta gli statement eseguiti sull'engine delle richieste."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@pytest.fixture(scope="module")
+def items(client):
+    """N items con la stessa parola chiave, con embedding pronto."""
+    location = client.post("/api/locations", json={"name": "Cassetta attrezzi"}).json()
+    ids = []
+    for i in range(N_ITEMS):
+        response = client.post(
+            "/api/items",
+            json={
+                "description": f"cacciavite a croce {i}",
+                "location_id": location["id"],
+                "photo_path": f"photos/{i}.jpg",
+                "thumbnail_path": f"thumbnails/{i}.jpg"
+            }
+        )
+        assert response.status_code == 201, response.text
+        ids.append(response.json()["id"])
+    
+    while process_pending_batch():
+        pass
+    return ids
+
+
+def _count_statements(client, method: str, limit: int):
+    counter = StatementCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        response = client.get(
+            "/api/search",
+            params={"q": "cacciavite", "method": method, "limit": limit}
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+    assert response.status_code == 200, response.text
+    return counter.count, response.json()
+
+
+@pytest.mark.parametrize("method", ["auto", "fts", "semantic", "hybrid", "like"])
+def test_statements_per_search_do_not_depend_on_hits(client, items, method):
+    # Prima ricerca a vuoto: eventuali inizializzazioni pigre non contano
+    _count_statements(client, method, 1)
+    
+    one, single = _count_statements(client, method, 1)
+    many, multiple = _count_statements(client, method, N_ITEMS)
+    
+    assert single["total"] == 1
+    assert multiple["total"] == N_ITEMS
+    assert one == many, (one, many)